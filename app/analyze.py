@@ -1,8 +1,12 @@
 import logging
 import os
+import threading
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool, cpu_count
-from typing import Any, List, Optional
+from queue import Empty, Queue
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
 
 import cv2
 import numpy as np
@@ -10,15 +14,21 @@ from PIL import Image
 
 from app.async_utils import load
 from app.clients import MyImgurClient, MyWallhavenClient, RedditClient
+from app.clients.base import Client, InsertMapping
+from app.colors import lab_histogram
 from app.config import config, is_windows
 from app.db import (
-    Wallpaper,
     all_local_wallpapers,
-    bulk_insert_colors,
     bulk_insert_wallpapers,
-    bulk_update_wallpapers,
-    create_session,
+    delete_local_wallpapers,
+    featureless_listings,
+    library_stats,
+    no_feature,
+    save_features,
+    save_sync_cursor,
+    unanalyzed_listings,
 )
+from app.writer import AnalysisWriter
 
 logger = logging.getLogger(__name__)
 
@@ -52,13 +62,18 @@ def common_colors(image: np.array, n_colors: int = 5) -> List[str]:
     )[0]
 
 
+def image_features(image_array: np.array) -> bytes:
+    """Compact color histogram feature vector of an RGB image array"""
+    return lab_histogram(image_array.reshape(-1, 3)).tobytes()
+
+
 def analyze_image(image):
     """
     Gather information on an image for search organization.
     :param PIL.Image image: image to analyze.
     :param int image_size: File size of the image, this is inaccurate to calculate from
                            the PIL.Image itself, should be gathered from the file itself.
-    :return dict: Dictionary of analysis data.
+    :return tuple: Dictionary of analysis data, palette colors and feature vector.
     """
 
     width, height = image.size
@@ -66,21 +81,38 @@ def analyze_image(image):
     #       what is the best size for speed vs accuracy tho?
     image.thumbnail((480, 270), Image.ANTIALIAS)
     image_array = np.asarray(image)
-    image.convert("L")
-    gray_image_array = np.asarray(image)
+    gray_image_array = np.asarray(image.convert("L"))
     colors = common_colors(image_array, 10)
     colors = [to_hex(*color) for color in colors]
 
-    return {
-        "dhash": str(dhash(gray_image_array)),
-        "width": width,
-        "height": height,
-        "analyzed": True,
-    }, colors
+    return (
+        {
+            "dhash": str(dhash(gray_image_array)),
+            "width": width,
+            "height": height,
+            "analyzed": True,
+        },
+        colors,
+        image_features(image_array),
+    )
+
+
+def inspect_image(uri: str) -> Optional[tuple]:
+    """
+    Load and analyze a single local file or url without adding it to the library.
+    Returns the same results as `analyze_image`, or None if the image can't be loaded.
+    """
+    (image,), err = load([uri], timeout=60)
+    if image is None:
+        return None
+    return analyze_image(image.convert("RGB"))
 
 
-def scan_local_images():
-    """Check local source for file changes and add/remove as needed"""
+def scan_local_images(chunk_size: int = 500):
+    """
+    Check local source for file changes and add/remove as needed.
+    New files are saved in committed chunks of `chunk_size`.
+    """
     # Get all known local entries and group by their dirs
     stored_sets = defaultdict(set)
     for wallpaper in all_local_wallpapers(2000):
@@ -98,6 +130,7 @@ def scan_local_images():
                 filename, ext = os.path.splitext(file)
                 found_sets[image_dir].add((f"{filename}{ext}", int(stat.st_ctime)))
 
+    new_images = 0
     for image_dir in config.core.image_dirs:
         added = found_sets[image_dir] - stored_sets[image_dir]
         removed = stored_sets[image_dir] - found_sets[image_dir]
@@ -116,51 +149,141 @@ def scan_local_images():
                     "file_ctime": ctime,
                 }
             )
-        if to_add:
-            bulk_insert_wallpapers(to_add)
+        for start in range(0, len(to_add), chunk_size):
+            bulk_insert_wallpapers(to_add[start : start + chunk_size])
+        new_images += len(to_add)
 
-        # TODO: This will not scale great, make a bulk routine?
-        for file in removed:
-            file, ctime = file
-            with create_session() as session:
-                session.query(Wallpaper).filter(
-                    Wallpaper.source_type == "local"
-                    and Wallpaper.source_id == file
-                    and Wallpaper.file_ctime == ctime
-                ).delete(synchronize_session=False)
-                session.commit()
+        if removed:
+            delete_local_wallpapers(image_dir, removed)
+
+    return new_images
+
+
+class CrawlProgress(NamedTuple):
+    """Running count of the new images a crawl has saved from each source"""
 
-    return len(to_add)
+    saved: Dict[str, int]
+
+    @property
+    def total(self) -> int:
+        return sum(self.saved.values())
+
+
+class SourceDone(NamedTuple):
+    """Marks the end of a source's entries on the crawl queue"""
+
+    source_type: str
+    # Sync cursor to save once the source's entries are all committed
+    cursor: Optional[str] = None
 
 
 class Crawler:
-    def __init__(self):
+    """
+    Gathers new images from the local image dirs and every enabled client source.
+    Sources are crawled concurrently, each on its own thread with its own rate limit
+    and cancel handle. Their entries are streamed into the library in committed
+    chunks of `batch_size`, so a canceled or failed crawl keeps everything fetched
+    so far. `progress` is called with a `CrawlProgress` after every chunk.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 100,
+        interval: float = 2.0,
+        progress: Optional[Callable[[CrawlProgress], None]] = None,
+    ):
         self.clients = (RedditClient, MyImgurClient, MyWallhavenClient)
-        self.client = self.clients[0]
-        self._cancel = False
+        self.batch_size = batch_size
+        self.interval = interval
+        self.progress = progress
+        self.running: Dict[str, Client] = {}
+        self._cancel = threading.Event()
 
     def cancel(self):
-        self.client.cancel = True
-        self._cancel = True
+        self._cancel.set()
+        for client in list(self.running.values()):
+            client.cancel()
         logger.info(f"Canceling Crawler run")
 
     @staticmethod
     def client_enabled(client) -> bool:
         return getattr(getattr(config, client.source_type), "enabled")
 
-    def __call__(self, limit: int) -> int:
-        new_images = 0
-        new_images += scan_local_images()
-        for client_cls in self.clients:
-            if self._cancel:
-                break
-            if not self.client_enabled(client_cls):
-                continue
-            self.client = client_cls()
-            data = [entry for entry in self.client.fetch(limit)]
-            bulk_insert_wallpapers(data)
-            new_images += len(data)
-        return new_images
+    def _crawl(self, client_cls, limit: int, full_sync: bool, results: Queue):
+        cursor = None
+        try:
+            if self._cancel.is_set():
+                return
+            client = client_cls()
+            client.full_sync = full_sync
+            self.running[client_cls.source_type] = client
+            # The crawler may have been canceled while the client was starting
+            if self._cancel.is_set():
+                client.cancel()
+            for entry in client.fetch(limit):
+                results.put(entry)
+            cursor = client.completed_cursor
+        except Exception:
+            logger.exception(f"Failed to crawl {client_cls.source_type} images")
+        finally:
+            results.put(SourceDone(client_cls.source_type, cursor))
+
+    def _report(self, saved: Dict[str, int]):
+        if self.progress is not None:
+            self.progress(CrawlProgress(dict(saved)))
+
+    def _save(self, pending: List[InsertMapping], saved: Dict[str, int]):
+        bulk_insert_wallpapers(pending)
+        for entry in pending:
+            saved[entry["source_type"]] += 1
+        logger.info(f"Saved {len(pending)} new images")
+        self._report(saved)
+
+    def __call__(self, limit: int, full_sync: bool = False) -> int:
+        """
+        Crawl for up to `limit` new images from each client source.
+        Clients stop at their last synced item unless `full_sync` is set.
+        """
+        self.running = {}
+        sources = [client for client in self.clients if self.client_enabled(client)]
+        # Bounded so a fast source waits on the inserts instead of piling up entries
+        results = Queue(maxsize=4 * self.batch_size)
+        saved = defaultdict(int)
+        with ThreadPoolExecutor(max_workers=len(sources) + 1) as pool:
+            local = pool.submit(scan_local_images, self.batch_size)
+            for client_cls in sources:
+                pool.submit(self._crawl, client_cls, limit, full_sync, results)
+
+            pending = []
+            finished = 0
+            try:
+                while finished < len(sources):
+                    try:
+                        entry = results.get(timeout=self.interval)
+                    except Empty:
+                        entry = ()
+                    done = isinstance(entry, SourceDone)
+                    if done:
+                        finished += 1
+                    elif entry:
+                        pending.append(entry)
+                    if pending and (
+                        done or not entry or len(pending) >= self.batch_size
+                    ):
+                        self._save(pending, saved)
+                        pending = []
+                    # Entries are queued in order so all of the source's are saved by now
+                    if done and entry.cursor is not None:
+                        save_sync_cursor(entry.source_type, entry.cursor)
+            except Exception:
+                # Stop the sources, their threads may be waiting on the full queue
+                self.cancel()
+                while finished < len(sources):
+                    finished += isinstance(results.get(), SourceDone)
+                raise
+            saved["local"] += local.result()
+            self._report(saved)
+        return sum(saved.values())
 
 
 class Inspector:
@@ -179,20 +302,18 @@ class Inspector:
         number_of_full_runs = limit // batch
         leftover = limit % batch
         processes = cpu_count()
+        # Results are saved in the background so walk the unanalyzed
+        # images by id instead of picking up ones waiting to be written
+        last_id = 0
 
         def analyze_set(num: int):
-            with create_session() as session:
-                to_analyze = (
-                    session.query(Wallpaper)
-                    .filter(Wallpaper.analyzed == False)
-                    .limit(num)
-                    .all()
-                )
+            nonlocal last_id
             uris = []
             _ids = []
-            for obj in to_analyze:
+            for obj in unanalyzed_listings(num, after_id=last_id):
                 uris.append(obj.src_path)
                 _ids.append(obj.id)
+                last_id = obj.id
 
             if self._cancel:
                 return
@@ -210,32 +331,115 @@ class Inspector:
 
             # For some reason the process pool spawns a bunch
             # of ui windows on windows os so lets not get fancy
+            # Results are handed to the writer as they complete so
+            # saving overlaps with the rest of the analysis
             if is_windows():
-                data = map(analyze_image, images)
+                for id, (entry, colors, feature) in zip(
+                    ids, map(analyze_image, images)
+                ):
+                    writer.put({"id": id, **entry}, colors, feature)
             else:
                 with Pool(processes=processes) as pool:
-                    data = pool.map(analyze_image, images)
-
-            to_update = []
-            wallpaper_to_colors = {}
-            for id, obj in zip(ids, data):
-                entry, colors = obj
-                to_update.append({"id": id, **entry})
-                wallpaper_to_colors[id] = colors
-
-            bulk_update_wallpapers(to_update)
-            bulk_insert_colors(wallpaper_to_colors)
-
-        if number_of_full_runs > 0:
-            for i in range(number_of_full_runs):
-                if self._cancel:
-                    return
-                logger.info(f"Inspecting set of {batch} images")
-                analyze_set(batch)
-                if step_callback is not None:
-                    step_callback((i / number_of_full_runs) * 100)
-
-        if self._cancel:
-            return
-        logger.info(f"Inspecting set of {leftover} images")
-        analyze_set(leftover)
+                    for id, (entry, colors, feature) in zip(
+                        ids, pool.imap(analyze_image, images)
+                    ):
+                        writer.put({"id": id, **entry}, colors, feature)
+
+        with AnalysisWriter() as writer:
+            if number_of_full_runs > 0:
+                for i in range(number_of_full_runs):
+                    if self._cancel:
+                        return
+                    logger.info(f"Inspecting set of {batch} images")
+                    analyze_set(batch)
+                    if step_callback is not None:
+                        step_callback((i / number_of_full_runs) * 100)
+
+            if self._cancel:
+                return
+            logger.info(f"Inspecting set of {leftover} images")
+            analyze_set(leftover)
+
+    def backfill_features(self, batch: int = 100):
+        """
+        Compute feature vectors for images analyzed before they were collected.
+        Returns the number of vectors saved.
+        """
+        last_id = 0
+        saved = 0
+        while not self._cancel:
+            listings = featureless_listings(batch, after_id=last_id)
+            if not listings:
+                break
+            last_id = listings[-1].id
+            logger.info(f"Collecting features for set of {len(listings)} images")
+
+            image_data, err = load([obj.src_path for obj in listings], timeout=60)
+            features = {}
+            for obj, data in zip(listings, image_data):
+                # Images that fail to load, like dead links, are marked
+                # so later scans don't download them again
+                if data is None:
+                    features[obj.id] = no_feature
+                else:
+                    data = data.convert("RGB")
+                    data.thumbnail((480, 270), Image.ANTIALIAS)
+                    features[obj.id] = image_features(np.asarray(data))
+                    saved += 1
+            save_features(features)
+        return saved
+
+
+class ScanStage(NamedTuple):
+    """Images handled by a stage of a scan and the time it took"""
+
+    images: int
+    seconds: float
+
+    @property
+    def rate(self) -> float:
+        return self.images / self.seconds if self.seconds else 0.0
+
+
+class Scanner:
+    """
+    Full library scan, crawl every source for new images then analyze everything
+    unanalyzed and backfill missing feature vectors. The images handled and time
+    taken by each stage are kept in `stages`.
+    """
+
+    def __init__(self, full_sync: bool = False, progress=None):
+        self._cancel = False
+        self.full_sync = full_sync
+        self.crawler = Crawler(progress=progress)
+        self.inspector = Inspector()
+        self.stages: Dict[str, ScanStage] = {}
+
+    def cancel(self):
+        self._cancel = True
+        self.crawler.cancel()
+        self.inspector.cancel()
+
+    def scan(self):
+        start = time.monotonic()
+        crawled = self.crawler(600, full_sync=self.full_sync)
+        self.stages["crawl"] = ScanStage(crawled, time.monotonic() - start)
+        # Size the analysis by everything still unanalyzed, which also
+        # covers images left over from earlier cancelled or failed scans
+        unanalyzed = sum(stats.unanalyzed for stats in library_stats().values())
+        if not self._cancel and unanalyzed:
+            start = time.monotonic()
+            self.inspector(limit=unanalyzed, batch=50)
+            left = sum(stats.unanalyzed for stats in library_stats().values())
+            self.stages["analyze"] = ScanStage(
+                unanalyzed - left, time.monotonic() - start
+            )
+        if not self._cancel:
+            start = time.monotonic()
+            backfilled = self.inspector.backfill_features(batch=50)
+            self.stages["features"] = ScanStage(backfilled, time.monotonic() - start)
+        for name, stage in self.stages.items():
+            logger.info(
+                f"Scan {name} stage handled {stage.images} images in {stage.seconds:.1f}s"
+            )
+        logger.info(f"Thread {threading.get_ident()} complete for image scans")
@@ -1,10 +1,8 @@
 # Some general notes on the client code
-# TODO: My method for finding new images is a bit greedy
-#   in that each client class gets all the saved source ids
-#   for it's type and then as many images that it can from
-#   whatever api and checks each source id against the saved.
-#   This is slow and would be worth looking at alternatives
-#   like cursoring or something.
+# Each client keeps a sync cursor, the newest item it saw on its last
+#   complete crawl, and stops walking its source once it gets back to it.
+#   Sources are still checked against the saved source ids for
+#   anything re-added or left over from a canceled crawl.
 # TODO: It would be worth migrating some of the auth handlers
 #   to full login integrations. Most apis support this in some capacity
 #   and would be a bit more secure than just having creds on file.
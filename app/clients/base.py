@@ -1,5 +1,10 @@
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Any, Generator, TypedDict
+from functools import cached_property
+from typing import Any, Generator, Optional, TypedDict
+
+from app.db import sync_cursor
 
 
 class InsertMapping(TypedDict):
@@ -12,12 +17,59 @@ class InsertMapping(TypedDict):
     analyzed: bool
 
 
+class RateLimiter:
+    """
+    Thread safe token bucket allowing `rate` calls every `per` seconds,
+    with bursts of up to `burst` calls after a quiet period.
+    """
+
+    def __init__(self, rate: float, per: float = 1.0, burst: int = 1):
+        self.rate = rate / per
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self, cancel: Optional[threading.Event] = None) -> bool:
+        """Block until a call is allowed. Returns False if canceled while waiting"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                delay = (1 - self.tokens) / self.rate
+            if cancel is None:
+                time.sleep(delay)
+            elif cancel.wait(delay):
+                return False
+
+
 class Client(ABC):
     """
     Abstract class for client instances.
     Allows for consistent usage, limiting control and canceling functionality.
+    Each instance has its own rate limit of `requests_per_minute` for calls
+    made through `throttle`, and can be canceled from any thread.
+
+    Crawls are incremental. Sources list items newest first, `images` sets
+    `next_cursor` from the newest item it sees and stops once it reaches the
+    `cursor` left by the last complete crawl. Once `fetch` walks everything
+    it hands the new cursor back as `completed_cursor`, for the caller to
+    save after every fetched entry is committed. Canceled or limited crawls
+    leave it unset so they pick up the rest next time. Set `full_sync` to
+    ignore the saved cursor.
     """
 
+    requests_per_minute: float = 60
+    full_sync: bool = False
+    next_cursor: Optional[str] = None
+    completed_cursor: Optional[str] = None
+
     @abstractmethod
     def to_db(self, obj: Any) -> InsertMapping:
         """Subclass this function. Transform data from client to a db friendly dict"""
@@ -29,18 +81,37 @@ class Client(ABC):
         for obj in [InsertMapping()]:
             yield obj
 
+    @cached_property
+    def limiter(self) -> RateLimiter:
+        return RateLimiter(self.requests_per_minute, per=60)
+
+    @property
+    def canceled(self) -> threading.Event:
+        # setdefault keeps a single event when first touched from two threads
+        return self.__dict__.setdefault("_canceled", threading.Event())
+
     def cancel(self):
-        self.cancel = True
+        self.canceled.set()
+
+    @cached_property
+    def cursor(self) -> Optional[str]:
+        """Cursor saved by the last complete crawl, None for a full sync"""
+        return None if self.full_sync else sync_cursor(self.source_type)
+
+    def throttle(self) -> bool:
+        """Wait on the client rate limit before an api call, False if canceled meanwhile"""
+        return self.limiter.wait(self.canceled)
 
     def fetch(self, limit: int) -> Generator[InsertMapping, None, None]:
         """Main entrypoint. Generate new image entries up to a limit or until canceled"""
         count = 0
-        self.cancel = False
         for image in self.images():
-            if count > limit or self.cancel:
-                break
+            if count > limit or self.canceled.is_set():
+                return
             data = self.to_db(image)
             if data is None:
                 continue
             count += 1
             yield data
+        if not self.canceled.is_set():
+            self.completed_cursor = self.next_cursor
@@ -3,14 +3,20 @@ application code for interacting with the Imgur API
 """
 
 import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
 import requests
+import requests.adapters
 from funcy import cached_property
 from imgurpython import ImgurClient
 
 from app.clients.base import Client
 from app.config import config
 from app.db import source_ids_by_type
+from app.http_cache import CachedSession
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +28,14 @@ class MyImgurClient(Client):
     """
 
     source_type = "imgur"
+    # Album details are requested directly, everything else goes through imgurpython
+    api_url = "https://api.imgur.com/3"
+    # Imgur reports the credits left on each response, see `check_rate_limit`
+    requests_per_minute = 600
+    album_workers = 4
+    # Seconds to reuse cached responses for, favorites are fetched by imgurpython
+    cache_ttls = {"/gallery/album/": 24 * 60 * 60}
+    paused_until = 0.0
 
     def __init__(self, *args, **kwargs):
         self.client_id = config.imgur.client_id
@@ -45,28 +59,98 @@ class MyImgurClient(Client):
     def saved_ids(self):
         return source_ids_by_type(self.source_type)
 
+    @cached_property
+    def session(self) -> CachedSession:
+        """Pooled, cached http session shared by the album fetch workers"""
+        session = CachedSession(self.cache_ttls)
+        session.headers["Authorization"] = f"Client-ID {self.client_id}"
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.album_workers)
+        session.mount("https://", adapter)
+        return session
+
+    def favorites(self):
+        """
+        Generator of favorited albums not yet synced.
+        Favorites are paged newest first, the cursor is the id of the newest favorite.
+        """
+        page = 0
+        while self.throttle():
+            favorites = self.client.get_account_favorites("me", page)
+            if not favorites:
+                return
+            for item in favorites:
+                if self.next_cursor is None:
+                    self.next_cursor = item.id
+                if item.id == self.cursor:
+                    return
+                yield item
+            page += 1
+
     def images(self):
         """
         Generator to return images from favorited imgur albums.
-        This is done in a synchronous manner by grabbing each albums detail data
-        and yielding all the images from each.
+        Album details are fetched concurrently by a few workers, running ahead of
+        the consumer by up to two albums each, and images are yielded in favorites order.
         Imgur API References:
         - https://apidocs.imgur.com/?version=latest#a432a8e6-2ece-4544-bc7a-2999eb586f06
         - https://apidocs.imgur.com/?version=latest#f64e44be-8bf3-47bb-90d5-d1bf39c5e417
         """
-        for item in self.client.get_account_favorites("me"):
-            logger.info(f"Pulling image gallery - {item.id}")
-            url = f"https://api.imgur.com/3/gallery/album/{item.id}"
-            response = requests.get(
-                url, headers={"Authorization": f"Client-ID {self.client_id}"}
-            )
-            data = response.json()
-            image_data = data["data"]["images"]
-            for image in image_data:
-                if image["id"] in self.saved_ids:
-                    continue
-                else:
-                    yield image
+        # Load these before the workers need them
+        self.saved_ids
+        self.session
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.album_workers) as pool:
+            try:
+                for item in self.favorites():
+                    pending.append(pool.submit(self.album_images, item))
+                    if len(pending) > 2 * self.album_workers:
+                        yield from pending.popleft().result()
+                while pending:
+                    yield from pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def album_images(self, item) -> List[dict]:
+        """The unsaved images in a favorited album"""
+        logger.info(f"Pulling image gallery - {item.id}")
+        url = f"{self.api_url}/gallery/album/{item.id}"
+        while True:
+            delay = self.paused_until - time.time()
+            if delay > 0 and self.canceled.wait(delay):
+                return []
+            if not self.session.fresh(url) and not self.throttle():
+                return []
+            response = self.session.get(url)
+            self.check_rate_limit(response)
+            # Rate limited requests are retried once the pause is over
+            if response.status_code != 429:
+                break
+        response.raise_for_status()
+        image_data = response.json()["data"]["images"]
+        return [image for image in image_data if image["id"] not in self.saved_ids]
+
+    def check_rate_limit(self, response: requests.Response):
+        """
+        Follow the credits Imgur reports on each response. Album fetches pause until
+        the user credits reset when they run low, and the crawl stops once the
+        daily application credits are spent.
+        Reference: https://apidocs.imgur.com/#rate-limits
+        """
+        headers = response.headers
+        client_remaining = headers.get("X-RateLimit-ClientRemaining")
+        if client_remaining is not None and int(client_remaining) <= 0:
+            logger.warning("Imgur daily client credits are spent, stopping crawl")
+            self.cancel()
+        user_remaining = headers.get("X-RateLimit-UserRemaining")
+        user_reset = headers.get("X-RateLimit-UserReset")
+        if response.status_code == 429 or (
+            user_remaining is not None and int(user_remaining) < self.album_workers
+        ):
+            reset = float(user_reset) if user_reset else time.time() + 60
+            if reset > self.paused_until:
+                logger.warning(f"Imgur rate limit reached, pausing until {reset}")
+                self.paused_until = reset
 
     @staticmethod
     def to_db(obj):
@@ -3,14 +3,18 @@ application code for interacting with the Reddit API
 """
 
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 import praw
 import requests
+import requests.adapters
 from funcy import cached_property
 
 from app.clients.base import Client
 from app.config import config, supported_formats, user_agent
-from app.db import source_ids_by_type
+from app.db import save_url_probes, source_ids_by_type, url_probes
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +26,16 @@ class RedditClient(Client):
     """
 
     source_type = "reddit"
+    reddit_url = "https://www.reddit.com"
+    oauth_url = "https://oauth.reddit.com"
+    probe_batch = 100
+    probe_workers = 8
+    # A week, after that links are probed again
+    probe_ttl = 7 * 24 * 60 * 60
+    # Statuses of links that are gone for good, other failures are retried
+    gone_statuses = (404, 410)
+    # Set when a probe failed for now, see `images`
+    probes_failed = False
 
     def __init__(self, *args, **kwargs):
         client_id = config.reddit.client_id
@@ -40,19 +54,39 @@ class RedditClient(Client):
             username=username,
             password=password,
             user_agent=user_agent,
+            reddit_url=self.reddit_url,
+            oauth_url=self.oauth_url,
         )
         logger.info("Starting client")
 
+    @cached_property
+    def content_types(self) -> Dict[str, Optional[str]]:
+        """Content types of probed links, None for links that are gone"""
+        return {}
+
     @cached_property
     def saved_ids(self):
         return source_ids_by_type(self.source_type)
 
-    def images(self):
+    @cached_property
+    def session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.probe_workers)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def submissions(self):
         """
         Returns a generator of reddit Submissions for saved posts from r/wallpaper/
         can provide a limit of images to grab at once.
+        Saved posts are listed newest first, the cursor is the fullname of the newest.
         """
         for item in self.reddit.user.me().saved(limit=1000):
+            if self.next_cursor is None:
+                self.next_cursor = item.fullname
+            if item.fullname == self.cursor:
+                return
             # TODO: Test with image galleries to see if it works
             if (
                 isinstance(item, praw.models.Submission)
@@ -63,32 +97,76 @@ class RedditClient(Client):
             ):
                 yield item
 
-    @staticmethod
-    def to_db(obj):
+    def images(self):
+        """
+        Saved submissions in batches of a listing page. Links without a known image
+        extension have their content type probed concurrently for each batch.
+        If any probe failed for now the crawl keeps the old cursor, so the
+        posts it skipped are listed again by the next one.
+        """
+        batch = []
+        for item in self.submissions():
+            batch.append(item)
+            if len(batch) >= self.probe_batch:
+                self.probe([item.url for item in batch])
+                yield from batch
+                batch = []
+        self.probe([item.url for item in batch])
+        yield from batch
+        if self.probes_failed:
+            self.next_cursor = self.cursor
+
+    def probe(self, urls: List[str]):
+        """
+        Find the content type of links without an image extension. Lasting results,
+        links that are gone included, are cached in the library for `probe_ttl`
+        seconds.
+        """
+        urls = [url for url in urls if url_extension(url) is None]
+        if not urls:
+            return
+        now = int(time.time())
+        self.content_types.update(url_probes(urls, now - self.probe_ttl))
+        urls = [url for url in set(urls) if url not in self.content_types]
+        if not urls:
+            return
+        with ThreadPoolExecutor(max_workers=self.probe_workers) as pool:
+            results = dict(zip(urls, pool.map(self.head, urls)))
+        probes = {
+            url: content for url, (content, lasting) in results.items() if lasting
+        }
+        self.probes_failed |= len(probes) < len(results)
+        save_url_probes(probes, now)
+        self.content_types.update(probes)
+
+    def head(self, url: str) -> Tuple[Optional[str], bool]:
+        """
+        Content type of a link, None if it can't be reached, and whether that is
+        a lasting answer. Timeouts, rate limits and server errors are not.
+        """
+        try:
+            response = self.session.head(url, timeout=30)
+            if response.status_code in self.gone_statuses:
+                return None, True
+            response.raise_for_status()
+        except requests.exceptions.RequestException:
+            logger.warning(f"Failed to probe image link - {url}")
+            return None, False
+        return response.headers.get("Content-Type"), True
+
+    def to_db(self, obj):
         # Reddit posts that are image links (common in this app)
         # do not store the image type directly like Imgur/Wallhaven.
         # We basically approximate it by the image link or the
         # content type of the link.
-        try:
-            ext = obj.url.split(".")[-1].strip()
-            assert ext in supported_formats
-        except (AssertionError, IndexError):
-            resp = requests.head(obj.url)
-            resp.raise_for_status()
-            content = resp.headers.get("Content-Type")
+        ext = url_extension(obj.url)
+        if ext is None:
+            content = self.content_types.get(obj.url) or ""
             if content.startswith("image/"):
-                _, ext = content.split("/")
-                if ext in supported_formats:
-                    pass
-                else:
-                    logger.warning("Failed to identify image type - {obj.url}")
-                    return None
-            else:
-                logger.warning("Failed to identify image type - {obj.url}")
+                _, ext = content.split("/", 1)
+            if ext not in supported_formats:
+                logger.warning(f"Failed to identify image type - {obj.url}")
                 return None
-        except requests.exceptions.RequestException:
-            logger.warning("Failed to identify image type - {obj.url}")
-            return None
 
         return {
             "source_uri": obj.url,
@@ -97,3 +175,9 @@ class RedditClient(Client):
             "image_type": ext,
             "analyzed": False,
         }
+
+
+def url_extension(url: str) -> Optional[str]:
+    """The supported image extension at the end of a url, if it has one"""
+    ext = url.split(".")[-1].strip()
+    return ext if ext in supported_formats else None
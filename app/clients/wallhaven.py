@@ -3,14 +3,20 @@ application code for interacting with the Wallhaven API
 """
 
 import logging
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
+from typing import List, Optional
 
 import requests
+import requests.adapters
 
 from app.clients.base import Client
 from app.config import config
 from app.db import source_ids_by_type
+from app.http_cache import CachedSession
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +27,12 @@ class MyWallhavenClient(Client):
     """
 
     source_type = "wallhaven"
+    api_url = "https://wallhaven.cc/api/v1"
+    requests_per_minute = 45
+    prefetch = 2
+    max_retries = 3
+    # Seconds to reuse cached responses for, collection pages then the collection list
+    cache_ttls = {"/collections/": 5 * 60, "/collections": 24 * 60 * 60}
 
     def __init__(self, *args, **kwargs):
         self.api_key = config.wallhaven.api_key
@@ -34,48 +46,131 @@ class MyWallhavenClient(Client):
     def saved_ids(self):
         return source_ids_by_type(self.source_type)
 
-    # TODO: might be good to wrap this a bit better for errors
-    def make_request(self, url, params={}):
-        params["apikey"] = self.api_key
-        response = requests.get(url, params=params)
-        if response.status_code == 429:
-            logger.warning("Rate limit encountered, waiting for 60 seconds")
-            time.sleep(60)
-            response = requests.get(url, params=params)
-        response_data = response.json()
-        data = response_data["data"]
+    @cached_property
+    def session(self) -> CachedSession:
+        session = CachedSession(self.cache_ttls)
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.prefetch + 1)
+        session.mount("https://", adapter)
+        return session
+
+    def wait(self, delay: float, stop: threading.Event) -> bool:
+        """Sleep for `delay` seconds, False if canceled or `stop` is set meanwhile"""
+        deadline = time.monotonic() + delay
+        while not self.canceled.is_set() and not stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            # Short slices so either event ends the wait soon after it is set
+            stop.wait(min(remaining, 0.25))
+        return False
+
+    def get_page(
+        self,
+        url: str,
+        params: dict,
+        page: int,
+        stop: Optional[threading.Event] = None,
+    ) -> Optional[dict]:
+        """
+        Request a single page of a listing under the client rate limit.
+        Rate limited requests wait out the Retry-After time, or a minute without one,
+        and are retried up to `max_retries` times. Returns None if the client is
+        canceled or `stop` is set meanwhile.
+        """
+        stop = stop or threading.Event()
+        params = {**params, "apikey": self.api_key, "page": page}
+        for attempt in range(self.max_retries + 1):
+            if not self.session.fresh(url, params) and not self.throttle():
+                return None
+            response = self.session.get(url, params=params)
+            if response.status_code != 429 or attempt == self.max_retries:
+                break
+            delay = float(response.headers.get("Retry-After", 60))
+            logger.warning(f"Rate limit encountered, waiting for {delay} seconds")
+            if not self.wait(delay, stop):
+                return None
+        response.raise_for_status()
+        return response.json()
+
+    def pages(self, url: str, params: Optional[dict] = None):
+        """
+        Generator of the data on each page of a listing. The first page gives the
+        page count, after that the next `prefetch` pages are requested in the
+        background while the current one is consumed. Closing the generator
+        early returns right away, pages not yet requested are dropped and
+        requests in flight stop at their next wait.
+        """
+        params = params or {}
+        response_data = self.get_page(url, params, 1)
+        if response_data is None:
+            return
+        yield response_data["data"]
 
         try:
             last_page = response_data["meta"]["last_page"]
         except KeyError:
             last_page = 1
+        remaining = iter(range(2, last_page + 1))
+        pending = deque()
+        stop = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=self.prefetch)
+        try:
+            for page in remaining:
+                pending.append(pool.submit(self.get_page, url, params, page, stop))
+                if len(pending) < self.prefetch:
+                    continue
+                response_data = pending.popleft().result()
+                if response_data is None:
+                    return
+                yield response_data["data"]
+            while pending:
+                response_data = pending.popleft().result()
+                if response_data is None:
+                    return
+                yield response_data["data"]
+        finally:
+            stop.set()
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+    def make_request(self, url: str, params: Optional[dict] = None) -> List[dict]:
+        return [obj for page in self.pages(url, params) for obj in page]
 
-        for page in range(2, last_page + 1):
-            params["page"] = page
-            response = requests.get(url, params=params)
-            if response.status_code == 429:
-                logger.warning("Rate limit encountered, waiting for 60 seconds")
-                time.sleep(60)
-                response = requests.get(url, params=params)
-            response_data = response.json()
-            page_data = response_data["data"]
-            data += page_data
-
-        return data
+    @cached_property
+    def synced(self):
+        """The collection id and newest wallpaper id saved in the sync cursor"""
+        if self.cursor is None:
+            return None, None
+        collection_id, wallpaper_id = self.cursor.split(":", 1)
+        return int(collection_id), wallpaper_id
 
     @cached_property
     def default_collection_id(self):
-        collections = self.make_request("https://wallhaven.cc/api/v1/collections")
+        collection_id, _ = self.synced
+        if collection_id is not None:
+            return collection_id
+        collections = self.make_request(f"{self.api_url}/collections")
         default_collection = [c for c in collections if c["label"] == "Default"][0]
         return default_collection["id"]
 
     def images(self):
-        url = f"https://wallhaven.cc/api/v1/collections/{self.username}/{self.default_collection_id}"
-        wallpapers = self.make_request(url)
-        for obj in wallpapers:
-            if obj["id"] in self.saved_ids:
-                continue
-            yield obj
+        """
+        Generator of unsaved wallpapers from the default collection, which lists
+        the most recently added first. The cursor holds the collection id and
+        newest wallpaper id, so a crawl with no changes needs a single request.
+        """
+        url = f"{self.api_url}/collections/{self.username}/{self.default_collection_id}"
+        _, synced_id = self.synced
+        for wallpapers in self.pages(url):
+            for obj in wallpapers:
+                if self.next_cursor is None:
+                    self.next_cursor = f"{self.default_collection_id}:{obj['id']}"
+                if obj["id"] == synced_id:
+                    return
+                if obj["id"] in self.saved_ids:
+                    continue
+                yield obj
 
     @staticmethod
     def to_db(obj):
@@ -0,0 +1,97 @@
+"""
+Vectorized color conversions from packed hex color values and sRGB to
+CIE Lab. This follows the same math as colormath's sRGB to Lab (d65, 2 degree
+observer) conversion but works on whole arrays of colors at once.
+"""
+
+import numpy as np
+
+# sRGB working space matrix, the same values used by colormath
+RGB_TO_XYZ = np.array(
+    [
+        [0.412424, 0.357579, 0.180464],
+        [0.212656, 0.715158, 0.0721856],
+        [0.0193324, 0.119193, 0.950444],
+    ]
+)
+# d65 reference white for the 2 degree observer
+D65 = np.array([0.95047, 1.0, 1.08883])
+CIE_E = 216.0 / 24389.0
+
+
+def hex_to_rgb(values) -> np.ndarray:
+    """Split packed 0xRRGGBB values into an (n, 3) array of 0-255 channels"""
+    values = np.asarray(values, dtype=np.int64).reshape(-1)
+    return np.stack(
+        ((values >> 16) & 0xFF, (values >> 8) & 0xFF, values & 0xFF), axis=1
+    )
+
+
+def rgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    """Convert an (n, 3) array of 0-255 sRGB channels to Lab"""
+    rgb = np.asarray(rgb, dtype=np.float64).reshape(-1, 3) / 255.0
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ RGB_TO_XYZ.T / D65
+    f = np.where(xyz > CIE_E, np.cbrt(xyz), 7.787 * xyz + 16.0 / 116.0)
+    lab = np.empty_like(f)
+    lab[:, 0] = 116.0 * f[:, 1] - 16.0
+    lab[:, 1] = 500.0 * (f[:, 0] - f[:, 1])
+    lab[:, 2] = 200.0 * (f[:, 1] - f[:, 2])
+    return lab
+
+
+def hex_to_lab(values) -> np.ndarray:
+    """Convert packed 0xRRGGBB values to an (n, 3) array of Lab values"""
+    return rgb_to_lab(hex_to_rgb(values))
+
+
+# Fixed vocabulary of Lab color bins. Palettes are also stored by bin so
+# color search works over a bounded set of values no matter the library size.
+# Bins cover the Lab range reachable from sRGB, about 5 units of L* by 8 of a* and b*.
+BIN_STEPS = np.array([20, 24, 26])
+BIN_LOW = np.array([0.0, -90.0, -110.0])
+BIN_SIZE = np.array([5.0, 8.0, 8.0])
+N_BINS = int(np.prod(BIN_STEPS))
+
+
+def lab_to_bin(lab: np.ndarray) -> np.ndarray:
+    """Quantize an (n, 3) array of Lab values to their color bin numbers"""
+    lab = np.asarray(lab, dtype=np.float64).reshape(-1, 3)
+    coords = np.floor((lab - BIN_LOW) / BIN_SIZE).astype(np.int64)
+    coords = np.clip(coords, 0, BIN_STEPS - 1)
+    return np.ravel_multi_index(coords.T, BIN_STEPS)
+
+
+def bin_to_lab(bins) -> np.ndarray:
+    """The Lab value at the center of each of the given color bins"""
+    coords = np.stack(
+        np.unravel_index(np.asarray(bins, dtype=np.int64), BIN_STEPS), axis=1
+    )
+    return BIN_LOW + (coords + 0.5) * BIN_SIZE
+
+
+def hex_to_bin(values) -> np.ndarray:
+    """Quantize packed 0xRRGGBB values to their color bin numbers"""
+    return lab_to_bin(hex_to_lab(values))
+
+
+# Coarser grid over the same Lab range for whole image color histograms
+FEATURE_STEPS = np.array([4, 6, 6])
+FEATURE_SIZE = int(np.prod(FEATURE_STEPS))
+
+
+def lab_histogram(rgb: np.ndarray) -> np.ndarray:
+    """
+    Color histogram of an (n, 3) array of 0-255 sRGB pixels over a coarse Lab grid,
+    as a compact uint8 feature vector. Bin shares are square rooted so the euclidean
+    distance between two vectors follows the Hellinger distance of the histograms.
+    """
+    lab = rgb_to_lab(rgb)
+    size = BIN_SIZE * BIN_STEPS / FEATURE_STEPS
+    coords = np.floor((lab - BIN_LOW) / size).astype(np.int64)
+    coords = np.clip(coords, 0, FEATURE_STEPS - 1)
+    counts = np.bincount(
+        np.ravel_multi_index(coords.T, FEATURE_STEPS), minlength=FEATURE_SIZE
+    )
+    shares = counts / max(counts.sum(), 1)
+    return np.round(np.sqrt(shares) * 255).astype(np.uint8)
@@ -34,12 +34,16 @@ class ConfigObject:
             return self.config.getlist(self.section, attr)
         elif attr == "enabled":
             return self.config.getboolean(self.section, attr.lower())
+        elif attr == "duplicate_radius":
+            return self.config.getint(self.section, attr)
         else:
             return self.config.get(self.section, attr)
 
     def __setattr__(self, attr, value):
         if attr == "image_dirs":
             value = ",".join(value)
+        elif attr == "duplicate_radius":
+            value = str(value)
         self.config.set(self.section, attr, value)
 
 
@@ -63,20 +67,26 @@ class Config:
             logs_level = "DEBUG"
             image_dirs = os.path.join(os.getcwd(), "images")
             download_loc = os.path.join(os.getcwd(), "images/downloads")
+            cache_loc = os.path.join(os.getcwd(), "cache")
         else:
             db_loc = os.path.join(user_data_dir(app_name), "data.db")
             logs_loc = os.path.join(user_data_dir(app_name), "app.log")
             logs_level = "WARN"
             image_dirs = ""
             download_loc = ""
+            cache_loc = os.path.join(user_data_dir(app_name), "cache")
 
         return {
             "core": {
                 "image_dirs": image_dirs,
                 "db_loc": db_loc,
                 "download_loc": download_loc,
+                # Cached api responses
+                "cache_loc": cache_loc,
                 "logs_loc": logs_loc,
                 "logs_level": logs_level,
+                # Max hamming distance between image hashes to count as duplicates
+                "duplicate_radius": "1",
             },
             "reddit": {
                 "enabled": "False",
@@ -108,10 +118,12 @@ class Config:
             config_file = os.path.join(user_config_dir(app_name), "config.ini")
         self.file_loc = config_file
 
+        # Defaults are applied first so options added in newer versions
+        # are still available with config files written by older ones
+        self.config.read_dict(self.default())
         if os.path.exists(self.file_loc):
             self.config.read(self.file_loc)
         else:
-            self.config.read_dict(self.default())
             with open(self.file_loc, "w") as config_file:
                 self.config.write(config_file)
 
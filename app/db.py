@@ -1,17 +1,60 @@
-from typing import Dict, List, Optional, Tuple, TypedDict
-
-from sqlalchemy import REAL, Boolean, Column, ForeignKey, Integer, String, create_engine
+import os
+from collections import defaultdict, namedtuple
+from functools import lru_cache
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypedDict,
+)
+
+from sqlalchemy import (
+    REAL,
+    Boolean,
+    Column,
+    ForeignKey,
+    Integer,
+    LargeBinary,
+    String,
+    bindparam,
+    case,
+    create_engine,
+    event,
+    func,
+    select,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Query, relationship, sessionmaker
 from sqlalchemy.sql.expression import cast
 
+from app.colors import hex_to_bin
 from app.config import config
 
 Base = declarative_base()
 
 
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # Write ahead logging lets the ui keep reading while scans write
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+@lru_cache(maxsize=None)
+def _engine(db_loc: str):
+    engine = create_engine(f"sqlite:///{db_loc}")
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
 def _create_engine():
-    return create_engine(f"sqlite:///{config.core.db_loc}")
+    return _engine(config.core.db_loc)
 
 
 def create_session():
@@ -24,6 +67,20 @@ def create_session():
 def create_tables():
     engine = _create_engine()
     Base.metadata.create_all(engine)
+    # `create_all` skips indexes added to tables that already exist
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    with create_session() as session:
+        if session.query(LibraryStats).first() is None:
+            refresh_library_stats()
+        if (
+            session.query(WallpaperColorBin).first() is None
+            and session.query(WallpaperColor).first() is not None
+        ):
+            refresh_color_bins()
+    if library_state("dhash_version") < 1:
+        rehash_wide_hashes()
 
 
 class WallpaperColor(Base):
@@ -32,13 +89,78 @@ class WallpaperColor(Base):
     wallpaper_id = Column(
         "wallpaper_id", Integer, ForeignKey("wallpapers.id"), nullable=False
     )
-    color_value = Column(Integer, nullable=False)
+    color_value = Column(Integer, nullable=False, index=True)
     rank = Column("rank", Integer, nullable=False)
     wallpaper = relationship("Wallpaper", back_populates="colors")
 
 
+class WallpaperColorBin(Base):
+    """
+    Inverted index of quantized palette colors, see `app.colors.hex_to_bin`.
+    Each row weights how prominent a color bin is in a wallpaper's palette.
+    """
+
+    __tablename__ = "wallpaper_color_bin"
+    # Without a rowid the table is clustered on its key so bin lookups
+    # read the wallpaper ids and weights straight from the key order
+    __table_args__ = {"sqlite_with_rowid": False}
+    bin = Column(Integer, primary_key=True, nullable=False)
+    wallpaper_id = Column(
+        Integer, ForeignKey("wallpapers.id"), primary_key=True, nullable=False
+    )
+    weight = Column(REAL, nullable=False)
+
+
+class WallpaperFeature(Base):
+    """
+    Color histogram feature vector of a wallpaper, see `app.colors.lab_histogram`.
+    Images that failed to load for one have the empty `no_feature` vector instead.
+    """
+
+    __tablename__ = "wallpaper_feature"
+    id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
+    wallpaper_id = Column(
+        Integer, ForeignKey("wallpapers.id"), nullable=False, unique=True
+    )
+    vector = Column(LargeBinary, nullable=False)
+
+
+class DuplicatePair(Base):
+    """Pairs of wallpapers with near identical image hashes, kept by `DuplicateIndex`"""
+
+    __tablename__ = "duplicate_pair"
+    __table_args__ = {"sqlite_with_rowid": False}
+    # The lower wallpaper id is always first
+    first_id = Column(Integer, ForeignKey("wallpapers.id"), primary_key=True)
+    second_id = Column(
+        Integer, ForeignKey("wallpapers.id"), primary_key=True, index=True
+    )
+    distance = Column(Integer, nullable=False)
+
+
+class WallpaperPaths:
+    """Path helpers shared by full wallpaper entities and listing rows"""
+
+    __slots__ = ()
+
+    @property
+    def filename(self) -> str:
+        return f"{self.source_id}.{self.image_type}"
+
+    @property
+    def src_path(self) -> str:
+        if self.source_type == "local":
+            return f"{self.source_uri}/{self.filename}"
+        else:
+            return self.source_uri
+
+    @property
+    def download_path(self) -> str:
+        return f"{config.core.download_loc}/{self.filename}"
+
+
 # TODO: Should I make the type fields enums or choice fields?
-class Wallpaper(Base):
+class Wallpaper(WallpaperPaths, Base):
     __tablename__ = "wallpapers"
     id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
     source_type = Column(String, nullable=False)
@@ -53,20 +175,157 @@ class Wallpaper(Base):
     duplicate = Column(Boolean, nullable=False, default=False)
     colors = relationship("WallpaperColor", back_populates="wallpaper")
 
-    @property
-    def filename(self) -> str:
-        return f"{self.source_id}.{self.image_type}"
 
-    @property
-    def src_path(self) -> str:
-        if self.source_type == "local":
-            return f"{self.source_uri}/{self.filename}"
-        else:
-            return self.source_uri
+listing_columns = (
+    Wallpaper.id,
+    Wallpaper.source_type,
+    Wallpaper.source_id,
+    Wallpaper.source_uri,
+    Wallpaper.image_type,
+)
+
+
+class WallpaperListing(
+    namedtuple("WallpaperListing", [column.key for column in listing_columns]),
+    WallpaperPaths,
+):
+    """
+    Read only row of the wallpaper columns needed to list and load images.
+    Plain tuples skip the ORM identity map so large listings stay cheap.
+    """
+
+    __slots__ = ()
+
+
+class LibraryState(Base):
+    """Key value store for small pieces of library wide state"""
+
+    __tablename__ = "library_state"
+    key = Column(String, primary_key=True, nullable=False)
+    value = Column(Integer, nullable=False, default=0)
+
+
+def _bump_state(connection, key: str, amount: int = 1):
+    table = LibraryState.__table__
+    connection.execute(
+        sqlite_insert(table)
+        .values(key=key, value=amount)
+        .on_conflict_do_update(
+            index_elements=[table.c.key], set_={"value": table.c.value + amount}
+        )
+    )
+
+
+def _bump_generation(connection):
+    """
+    Every write to the library bumps the generation so cached
+    search results and indexes know when they are stale
+    """
+    _bump_state(connection, "generation")
+
+
+def library_state(key: str) -> int:
+    with create_session() as session:
+        value = (
+            session.query(LibraryState.value).filter(LibraryState.key == key).scalar()
+        )
+    return value or 0
+
+
+def library_generation() -> int:
+    return library_state("generation")
+
+
+class LibraryStats(Base):
+    """Running wallpaper counts per source, maintained by the db writers"""
+
+    __tablename__ = "library_stats"
+    source_type = Column(String, primary_key=True, nullable=False)
+    total = Column(Integer, nullable=False, default=0)
+    analyzed = Column(Integer, nullable=False, default=0)
+    duplicates = Column(Integer, nullable=False, default=0)
+
+
+class SourceStats(NamedTuple):
+    total: int
+    analyzed: int
+    duplicates: int
 
     @property
-    def download_path(self) -> str:
-        return f"{config.core.download_loc}/{self.filename}"
+    def unanalyzed(self) -> int:
+        return self.total - self.analyzed
+
+
+def _bump_stats(connection, counts: Dict[str, Dict[str, int]]):
+    """Add to the per source counts, given as `{source_type: {column: amount}}`"""
+    table = LibraryStats.__table__
+    for source_type, amounts in counts.items():
+        values = {"total": 0, "analyzed": 0, "duplicates": 0, **amounts}
+        stmt = sqlite_insert(table).values(source_type=source_type, **values)
+        connection.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[table.c.source_type],
+                set_={
+                    column: table.c[column] + stmt.excluded[column]
+                    for column in amounts
+                },
+            )
+        )
+
+
+def _count_by_source(connection, ids: List[int], *criteria) -> Dict[str, int]:
+    """Count the given wallpapers matching some criteria, grouped by source"""
+    wallpapers = Wallpaper.__table__
+    counts = defaultdict(int)
+    for start in range(0, len(ids), id_chunk_size):
+        rows = connection.execute(
+            select(wallpapers.c.source_type, func.count())
+            .where(wallpapers.c.id.in_(ids[start : start + id_chunk_size]), *criteria)
+            .group_by(wallpapers.c.source_type)
+        )
+        for source_type, count in rows:
+            counts[source_type] += count
+    return counts
+
+
+def refresh_library_stats():
+    """Rebuild the library counts from scratch"""
+    wallpapers = Wallpaper.__table__
+    stats = LibraryStats.__table__
+    query = select(
+        wallpapers.c.source_type,
+        func.count(),
+        func.count().filter(wallpapers.c.analyzed == True),
+        func.count().filter(wallpapers.c.duplicate == True),
+    ).group_by(wallpapers.c.source_type)
+    with _create_engine().begin() as connection:
+        rows = connection.execute(query).all()
+        connection.execute(stats.delete())
+        if rows:
+            connection.execute(
+                stats.insert(),
+                [
+                    {
+                        "source_type": source_type,
+                        "total": total,
+                        "analyzed": analyzed,
+                        "duplicates": duplicates,
+                    }
+                    for source_type, total, analyzed, duplicates in rows
+                ],
+            )
+
+
+def library_stats() -> Dict[str, SourceStats]:
+    """Wallpaper counts for each source type"""
+    with create_session() as session:
+        rows = session.query(
+            LibraryStats.source_type,
+            LibraryStats.total,
+            LibraryStats.analyzed,
+            LibraryStats.duplicates,
+        ).all()
+    return {row[0]: SourceStats(*row[1:]) for row in rows}
 
 
 class QueryDict(TypedDict):
@@ -75,7 +334,8 @@ class QueryDict(TypedDict):
     # especially with the join on color search
     #  OrderedDict ¯\_(ツ)_/¯
     ids: Optional[List[int]]
-    colors: Optional[List[int]]
+    # Mapping of color bins to their distance from the searched color
+    colors: Optional[Dict[int, float]]
     source_types: Optional[List[str]]
     aspect_ratio: Optional[float]
 
@@ -92,15 +352,35 @@ class WallpaperQuery:
             func = getattr(self, f"by_{key}")
             self.query = func(value)
 
-    def by_colors(self, colors: List[int]) -> Query:
-        return (
-            self.query.join(Wallpaper.colors)
-            .filter(WallpaperColor.color_value.in_(colors))
-            .order_by(WallpaperColor.rank)
+    def by_colors(self, colors: Dict[int, float]) -> Query:
+        # No matching color bins match no wallpapers
+        if not colors:
+            return self.query.filter(Wallpaper.id.in_([]))
+        # Score each wallpaper once by summing its matching palette bins.
+        # A match counts more the closer the bin is to the searched color and
+        # the more prominent it is in the palette, so a wallpaper matching several
+        # nearby colors ranks higher instead of showing up once per match.
+        closeness = case(
+            {_bin: 1.0 / (1.0 + distance) for _bin, distance in colors.items()},
+            value=WallpaperColorBin.bin,
+        )
+        score = func.sum(closeness * WallpaperColorBin.weight).label("score")
+        scores = (
+            Query([WallpaperColorBin.wallpaper_id, score])
+            .filter(WallpaperColorBin.bin.in_(colors))
+            .group_by(WallpaperColorBin.wallpaper_id)
+            .subquery()
+        )
+        return self.query.join(scores, scores.c.wallpaper_id == Wallpaper.id).order_by(
+            scores.c.score.desc(), Wallpaper.id
         )
 
     def by_ids(self, ids: List[int]) -> Query:
-        return self.query.filter(Wallpaper.id.in_(ids))
+        if not ids:
+            return self.query.filter(Wallpaper.id.in_(ids))
+        # Keep results in the order the ids were given
+        position = case({_id: ix for ix, _id in enumerate(ids)}, value=Wallpaper.id)
+        return self.query.filter(Wallpaper.id.in_(ids)).order_by(position)
 
     def by_source_types(self, source_types: List[str]) -> Query:
         return self.query.filter(Wallpaper.source_type.in_(source_types))
@@ -113,14 +393,65 @@ class WallpaperQuery:
             (cast(Wallpaper.width, REAL) / Wallpaper.height) == aspect_ratio
         )
 
-    def __call__(self, limit: int = 10) -> List[Wallpaper]:
+    def __call__(self, limit: int = 10, offset: int = 0) -> List[WallpaperListing]:
         with create_session() as session:
-            return (
+            rows = (
                 self.query.with_session(session)
+                .with_entities(*listing_columns)
                 .filter(Wallpaper.duplicate == False)
                 .limit(limit)
+                .offset(offset)
+                .all()
+            )
+        return [WallpaperListing._make(row) for row in rows]
+
+
+# Stay well under the sqlite bound parameter limit for `IN` clauses
+id_chunk_size = 500
+# Feature vector saved for images that couldn't be loaded, so they aren't retried
+no_feature = b""
+
+
+def wallpaper_listings(ids: Iterable[int]) -> List[WallpaperListing]:
+    """Gather listing rows for the given ids, in the order they were given"""
+    ids = list(ids)
+    by_id = {}
+    with create_session() as session:
+        for start in range(0, len(ids), id_chunk_size):
+            rows = (
+                session.query(*listing_columns)
+                .filter(Wallpaper.id.in_(ids[start : start + id_chunk_size]))
                 .all()
             )
+            for row in rows:
+                by_id[row[0]] = WallpaperListing._make(row)
+    return [by_id[_id] for _id in ids if _id in by_id]
+
+
+def wallpaper_resolutions(ids: Iterable[int]) -> Dict[int, int]:
+    """Pixel counts, width times height, of the given wallpapers"""
+    ids = list(ids)
+    resolutions = {}
+    with create_session() as session:
+        for start in range(0, len(ids), id_chunk_size):
+            rows = session.query(
+                Wallpaper.id, func.coalesce(Wallpaper.width * Wallpaper.height, 0)
+            ).filter(Wallpaper.id.in_(ids[start : start + id_chunk_size]))
+            resolutions.update(rows)
+    return resolutions
+
+
+def unanalyzed_listings(limit: int, after_id: int = 0) -> List[WallpaperListing]:
+    """Gather unanalyzed wallpapers in id order, starting after a given id"""
+    with create_session() as session:
+        rows = (
+            session.query(*listing_columns)
+            .filter(Wallpaper.analyzed == False, Wallpaper.id > after_id)
+            .order_by(Wallpaper.id)
+            .limit(limit)
+            .all()
+        )
+    return [WallpaperListing._make(row) for row in rows]
 
 
 def all_local_wallpapers(limit: int) -> List[Wallpaper]:
@@ -138,14 +469,89 @@ def all_local_wallpapers(limit: int) -> List[Wallpaper]:
 # of gathering source ids to check against when pulling images.
 # This is tricky because each api has its own rules/paradigms for paging
 # but possibly I could store a `cursor` value to track where each source is?
-def source_ids_by_type(source_type: str) -> Tuple[str]:
+def source_ids_by_type(source_type: str) -> FrozenSet[str]:
     with create_session() as session:
         query = (
             session.query(Wallpaper.source_id)
             .filter(Wallpaper.source_type == source_type)
             .all()
         )
-    return tuple(entry[0] for entry in query)
+    return frozenset(entry[0] for entry in query)
+
+
+class SyncCursor(Base):
+    """Where each client source left off on its last complete crawl"""
+
+    __tablename__ = "sync_cursor"
+    source_type = Column(String, primary_key=True, nullable=False)
+    cursor = Column(String, nullable=False)
+
+
+def sync_cursor(source_type: str) -> Optional[str]:
+    with create_session() as session:
+        return (
+            session.query(SyncCursor.cursor)
+            .filter(SyncCursor.source_type == source_type)
+            .scalar()
+        )
+
+
+def save_sync_cursor(source_type: str, cursor: str):
+    table = SyncCursor.__table__
+    with create_session() as session:
+        session.execute(
+            sqlite_insert(table)
+            .values(source_type=source_type, cursor=cursor)
+            .on_conflict_do_update(
+                index_elements=[table.c.source_type], set_={"cursor": cursor}
+            )
+        )
+        session.commit()
+
+
+class UrlProbe(Base):
+    """Cached content type of image links, null when the probe failed"""
+
+    __tablename__ = "url_probe"
+    url = Column(String, primary_key=True, nullable=False)
+    content_type = Column(String, nullable=True)
+    checked = Column(Integer, nullable=False)
+
+
+def url_probes(urls: Iterable[str], since: int) -> Dict[str, Optional[str]]:
+    """Content types of the urls probed at or after the `since` timestamp"""
+    probes = {}
+    urls = list(urls)
+    with create_session() as session:
+        for start in range(0, len(urls), id_chunk_size):
+            query = session.query(UrlProbe.url, UrlProbe.content_type).filter(
+                UrlProbe.url.in_(urls[start : start + id_chunk_size]),
+                UrlProbe.checked >= since,
+            )
+            probes.update(query.all())
+    return probes
+
+
+def save_url_probes(probes: Dict[str, Optional[str]], checked: int):
+    if not probes:
+        return
+    table = UrlProbe.__table__
+    statement = sqlite_insert(table)
+    with create_session() as session:
+        session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[table.c.url],
+                set_={
+                    "content_type": statement.excluded.content_type,
+                    "checked": statement.excluded.checked,
+                },
+            ),
+            [
+                {"url": url, "content_type": content_type, "checked": checked}
+                for url, content_type in probes.items()
+            ],
+        )
+        session.commit()
 
 
 def wallpaper_by_id(_id: int) -> Wallpaper:
@@ -162,6 +568,133 @@ def all_colors() -> List[Tuple[int]]:
     return query
 
 
+def colors_since(row_id: int) -> Tuple[List[int], int]:
+    """
+    Gather the distinct colors saved after a given color row id.
+    Returns the colors and the latest color row id to continue from.
+    """
+    with create_session() as session:
+        # Read the last id first so colors saved meanwhile are left for the next call
+        last_id = session.query(func.max(WallpaperColor.id)).scalar() or 0
+        colors = (
+            session.query(WallpaperColor.color_value)
+            .filter(WallpaperColor.id > row_id, WallpaperColor.id <= last_id)
+            .distinct()
+            .all()
+        )
+    return [color for color, in colors], last_id
+
+
+def features_since(row_id: int) -> Tuple[List[Tuple[int, bytes]], int]:
+    """
+    Gather the wallpaper ids and feature vectors saved after a given feature row id.
+    Returns the vectors and the latest feature row id to continue from.
+    """
+    with create_session() as session:
+        last_id = session.query(func.max(WallpaperFeature.id)).scalar() or 0
+        rows = (
+            session.query(WallpaperFeature.wallpaper_id, WallpaperFeature.vector)
+            .filter(
+                WallpaperFeature.id > row_id,
+                WallpaperFeature.id <= last_id,
+                WallpaperFeature.vector != no_feature,
+            )
+            .all()
+        )
+    return [tuple(row) for row in rows], last_id
+
+
+def feature_vectors(ids: Iterable[int]) -> Dict[int, bytes]:
+    """Feature vectors of the given wallpapers, if they have one"""
+    ids = list(ids)
+    vectors = {}
+    with create_session() as session:
+        for start in range(0, len(ids), id_chunk_size):
+            rows = session.query(
+                WallpaperFeature.wallpaper_id, WallpaperFeature.vector
+            ).filter(
+                WallpaperFeature.wallpaper_id.in_(ids[start : start + id_chunk_size]),
+                WallpaperFeature.vector != no_feature,
+            )
+            vectors.update(rows)
+    return vectors
+
+
+def featureless_listings(limit: int, after_id: int = 0) -> List[WallpaperListing]:
+    """
+    Gather analyzed wallpapers without a feature vector in id order,
+    those that already failed to load for one are skipped
+    """
+    with create_session() as session:
+        rows = (
+            session.query(*listing_columns)
+            .outerjoin(WallpaperFeature, WallpaperFeature.wallpaper_id == Wallpaper.id)
+            .filter(
+                Wallpaper.analyzed == True,
+                WallpaperFeature.id == None,
+                Wallpaper.id > after_id,
+            )
+            .order_by(Wallpaper.id)
+            .limit(limit)
+            .all()
+        )
+    return [WallpaperListing._make(row) for row in rows]
+
+
+def _insert_features(connection, features: Dict[int, bytes]):
+    # Replaced vectors, like those of images that failed to load before,
+    # get a new row id so search indexes pick them up as new
+    connection.execute(
+        WallpaperFeature.__table__.insert().prefix_with("OR REPLACE"),
+        [
+            {"wallpaper_id": wallpaper_id, "vector": vector}
+            for wallpaper_id, vector in features.items()
+        ],
+    )
+
+
+def save_features(features: Dict[int, bytes]):
+    """Save feature vectors for wallpapers analyzed before they were collected"""
+    if not features:
+        return
+    with _create_engine().begin() as connection:
+        _insert_features(connection, features)
+        _bump_generation(connection)
+
+
+def color_bins() -> List[int]:
+    """All color bins used by at least one wallpaper"""
+    with create_session() as session:
+        query = session.query(WallpaperColorBin.bin).distinct().all()
+    return [_bin for _bin, in query]
+
+
+def duplicate_pairs(radius: int) -> List[Tuple[int, int, int]]:
+    """All known pairs of duplicate wallpapers within a hamming distance"""
+    with create_session() as session:
+        query = (
+            session.query(
+                DuplicatePair.first_id, DuplicatePair.second_id, DuplicatePair.distance
+            )
+            .filter(DuplicatePair.distance <= radius)
+            .all()
+        )
+    return [tuple(row) for row in query]
+
+
+def _insert_pairs(connection, pairs: List[dict]):
+    if pairs:
+        connection.execute(
+            sqlite_insert(DuplicatePair.__table__).on_conflict_do_nothing(), pairs
+        )
+
+
+def add_duplicate_pairs(pairs: List[dict]):
+    """Save pairs of duplicate wallpapers, given as `first_id`, `second_id` and `distance`"""
+    with _create_engine().begin() as connection:
+        _insert_pairs(connection, pairs)
+
+
 class InsertMapping(TypedDict):
     source_type: str
     source_id: str
@@ -179,38 +712,229 @@ class UpdateMapping(TypedDict):
 
 
 def bulk_insert_wallpapers(mappings: List[InsertMapping]):
+    counts = defaultdict(lambda: defaultdict(int))
+    for mapping in mappings:
+        counts[mapping["source_type"]]["total"] += 1
+        counts[mapping["source_type"]]["analyzed"] += int(mapping["analyzed"])
     with create_session() as session:
         session.bulk_insert_mappings(Wallpaper, mappings)
+        _bump_stats(session, counts)
+        _bump_generation(session)
         session.commit()
 
 
+def _newly_analyzed(connection, mappings: List[UpdateMapping]) -> Dict[str, dict]:
+    ids = [mapping["id"] for mapping in mappings if mapping.get("analyzed")]
+    counts = _count_by_source(connection, ids, Wallpaper.analyzed == False)
+    return {source_type: {"analyzed": count} for source_type, count in counts.items()}
+
+
 def bulk_update_wallpapers(mappings: List[UpdateMapping]):
     with create_session() as session:
+        counts = _newly_analyzed(session, mappings)
         session.bulk_update_mappings(Wallpaper, mappings)
+        _bump_stats(session, counts)
+        _bump_generation(session)
         session.commit()
 
 
-def bulk_insert_colors(wallpaper_to_colors: Dict[int, List[int]]):
+def delete_local_wallpapers(image_dir: str, files: Iterable[Tuple[str, int]]):
+    """Remove local wallpapers, and their colors, by their filename and ctime"""
     with create_session() as session:
-        mappings = []
-        for wallpaper_id, colors in wallpaper_to_colors.items():
-            for rank, color_value in enumerate(colors):
-                mappings.append(
-                    {
-                        "color_value": color_value,
-                        "rank": rank,
-                        "wallpaper_id": wallpaper_id,
-                    }
+        ids = []
+        for file, ctime in files:
+            source_id, ext = os.path.splitext(file)
+            ids += [
+                _id
+                for _id, in session.query(Wallpaper.id).filter(
+                    Wallpaper.source_type == "local",
+                    Wallpaper.source_uri == image_dir,
+                    Wallpaper.source_id == source_id,
+                    Wallpaper.image_type == ext[1:],
+                    Wallpaper.file_ctime == ctime,
                 )
-        session.bulk_insert_mappings(WallpaperColor, mappings)
+            ]
+        counts = defaultdict(dict)
+        for column, criteria in (
+            ("total", ()),
+            ("analyzed", (Wallpaper.analyzed == True,)),
+            ("duplicates", (Wallpaper.duplicate == True,)),
+        ):
+            for source_type, count in _count_by_source(session, ids, *criteria).items():
+                counts[source_type][column] = -count
+        _bump_stats(session, counts)
+
+        for start in range(0, len(ids), id_chunk_size):
+            chunk = ids[start : start + id_chunk_size]
+            for table in (WallpaperColor, WallpaperColorBin, WallpaperFeature):
+                session.query(table).filter(table.wallpaper_id.in_(chunk)).delete(
+                    synchronize_session=False
+                )
+            session.query(DuplicatePair).filter(
+                DuplicatePair.first_id.in_(chunk) | DuplicatePair.second_id.in_(chunk)
+            ).delete(synchronize_session=False)
+            session.query(Wallpaper).filter(Wallpaper.id.in_(chunk)).delete(
+                synchronize_session=False
+            )
+        # Removals can leave colors unused, which color indexes need to know about
+        _bump_state(session, "removals")
+        _bump_generation(session)
+        session.commit()
+
+
+def bulk_insert_colors(wallpaper_to_colors: Dict[int, List[int]]):
+    with create_session() as session:
+        session.bulk_insert_mappings(WallpaperColor, _color_rows(wallpaper_to_colors))
+        session.bulk_insert_mappings(WallpaperColorBin, _bin_rows(wallpaper_to_colors))
+        _bump_generation(session)
         session.commit()
 
 
+def _color_rows(wallpaper_to_colors: Dict[int, List[int]]) -> List[dict]:
+    return [
+        {"color_value": color_value, "rank": rank, "wallpaper_id": wallpaper_id}
+        for wallpaper_id, colors in wallpaper_to_colors.items()
+        for rank, color_value in enumerate(colors)
+    ]
+
+
+def _bin_rows(wallpaper_to_colors: Dict[int, List[int]]) -> List[dict]:
+    """Quantize each palette into color bins weighted by palette rank"""
+    rows = []
+    for wallpaper_id, colors in wallpaper_to_colors.items():
+        if not colors:
+            continue
+        weights = defaultdict(float)
+        for rank, _bin in enumerate(hex_to_bin(colors).tolist()):
+            weights[_bin] += 1.0 / (rank + 1)
+        rows += [
+            {"bin": _bin, "wallpaper_id": wallpaper_id, "weight": weight}
+            for _bin, weight in weights.items()
+        ]
+    return rows
+
+
+def refresh_color_bins():
+    """Rebuild the color bin index from the stored palettes"""
+    colors = WallpaperColor.__table__
+    query = select(colors.c.wallpaper_id, colors.c.color_value).order_by(
+        colors.c.wallpaper_id, colors.c.rank
+    )
+    with _create_engine().begin() as connection:
+        connection.execute(WallpaperColorBin.__table__.delete())
+        palettes = defaultdict(list)
+        for wallpaper_id, color_value in connection.execute(query):
+            palettes[wallpaper_id].append(color_value)
+        rows = _bin_rows(palettes)
+        if rows:
+            connection.execute(WallpaperColorBin.__table__.insert(), rows)
+        _bump_generation(connection)
+
+
+def write_analysis(
+    mappings: List[UpdateMapping],
+    wallpaper_to_colors: Dict[int, List[int]],
+    pairs: Optional[List[dict]] = None,
+    features: Optional[Dict[int, bytes]] = None,
+):
+    """
+    Save a batch of analysis results, with their feature vectors and any
+    duplicate pairs found for them, in a single transaction. Uses core
+    executemany statements to skip the per object overhead of the orm.
+    """
+    wallpapers = Wallpaper.__table__
+    update = (
+        wallpapers.update()
+        .where(wallpapers.c.id == bindparam("_id"))
+        .values(
+            dhash=bindparam("dhash"),
+            width=bindparam("width"),
+            height=bindparam("height"),
+            analyzed=bindparam("analyzed"),
+        )
+    )
+    params = [
+        {
+            "_id": mapping["id"],
+            "dhash": mapping["dhash"],
+            "width": mapping["width"],
+            "height": mapping["height"],
+            "analyzed": mapping["analyzed"],
+        }
+        for mapping in mappings
+    ]
+    color_rows = _color_rows(wallpaper_to_colors)
+    bin_rows = _bin_rows(wallpaper_to_colors)
+
+    with _create_engine().begin() as connection:
+        _bump_stats(connection, _newly_analyzed(connection, mappings))
+        if params:
+            connection.execute(update, params)
+        if color_rows:
+            connection.execute(WallpaperColor.__table__.insert(), color_rows)
+        if bin_rows:
+            connection.execute(WallpaperColorBin.__table__.insert(), bin_rows)
+        if features:
+            _insert_features(connection, features)
+        _insert_pairs(connection, pairs or [])
+        _bump_generation(connection)
+
+
+def rehash_wide_hashes():
+    """
+    Hashes saved before images were hashed in grayscale hold three interleaved
+    rgb channels for 192 bits and can't be compared with the 64 bit ones. Those
+    images are marked unanalyzed, dropping their colors, so the next scan
+    analyzes them again. Run once on older libraries.
+    """
+    wallpapers = Wallpaper.__table__
+    with _create_engine().begin() as connection:
+        rows = connection.execute(
+            select(wallpapers.c.id, wallpapers.c.dhash).where(
+                wallpapers.c.dhash != None
+            )
+        )
+        ids = [_id for _id, dhash in rows if int(dhash) >> 64]
+        counts = _count_by_source(connection, ids, wallpapers.c.analyzed == True)
+        _bump_stats(
+            connection,
+            {
+                source_type: {"analyzed": -count}
+                for source_type, count in counts.items()
+            },
+        )
+        for start in range(0, len(ids), id_chunk_size):
+            chunk = ids[start : start + id_chunk_size]
+            for table in (WallpaperColor.__table__, WallpaperColorBin.__table__):
+                connection.execute(
+                    table.delete().where(table.c.wallpaper_id.in_(chunk))
+                )
+            connection.execute(
+                wallpapers.update()
+                .where(wallpapers.c.id.in_(chunk))
+                .values(dhash=None, analyzed=False)
+            )
+        if ids:
+            # Dropped colors have to be known to the color indexes
+            _bump_state(connection, "removals")
+            _bump_generation(connection)
+        _bump_state(connection, "dhash_version")
+
+
 def set_duplicate(ids: List[int]):
     with create_session() as session:
+        counts = _count_by_source(session, ids, Wallpaper.duplicate == False)
+        _bump_stats(
+            session,
+            {
+                source_type: {"duplicates": count}
+                for source_type, count in counts.items()
+            },
+        )
         session.query(Wallpaper).filter(Wallpaper.id.in_(ids)).update(
             {Wallpaper.duplicate: True}
         )
+        _bump_generation(session)
         session.commit()
 
 
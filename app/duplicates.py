@@ -0,0 +1,118 @@
+"""
+Near duplicate tracking shared by duplicate search and the analysis writer
+"""
+
+import logging
+import os
+import threading
+from typing import List, Tuple
+
+import numpy as np
+
+from app.config import config
+from app.db import Wallpaper, add_duplicate_pairs, create_session
+from app.index import HammingIndex
+
+logger = logging.getLogger(__name__)
+
+
+def analyzed_hashes() -> Tuple[np.ndarray, np.ndarray]:
+    """Arrays of the ids and 64 bit dhash values of all analyzed images, sorted by id"""
+    with create_session() as session:
+        query = (
+            session.query(Wallpaper.id, Wallpaper.dhash)
+            .filter(Wallpaper.dhash != None)
+            .order_by(Wallpaper.id)
+            .all()
+        )
+    ids = np.fromiter((_id for _id, _ in query), dtype=np.int64, count=len(query))
+    dhashes = np.array([int(_dhash) for _, _dhash in query], dtype=np.uint64)
+    return ids, dhashes
+
+
+class DuplicateIndex:
+    """
+    Persisted near duplicate index. The dhash of every analyzed image is kept in a
+    `HammingIndex` snapshot next to the db, and every pair of images within
+    `max_radius` bits of each other is kept in the duplicate_pair table.
+    New images are only checked against the index, so the known pairs stay
+    current without comparing the whole library again.
+    """
+
+    # Pairs are found up to this distance so any radius below it is a plain read.
+    # Larger radii split hashes into short bands which match too many candidates.
+    max_radius = 4
+    # The search and analysis writer threads each keep an instance,
+    # they take turns loading, syncing and saving the shared snapshot
+    _lock = threading.RLock()
+
+    def __init__(self) -> None:
+        with self._lock:
+            # Whether the index has changes that aren't in the snapshot yet
+            self.changed = False
+            self.index, _ = HammingIndex.load(self.snapshot_path())
+            if self.index is None or self.index.radius != self.max_radius:
+                self.index = HammingIndex(np.empty(0), radius=self.max_radius)
+            self.sync()
+
+    @staticmethod
+    def snapshot_path() -> str:
+        return os.path.join(os.path.dirname(config.core.db_loc), "duplicate_index")
+
+    @classmethod
+    def exists(cls) -> bool:
+        return os.path.exists(f"{cls.snapshot_path()}.json")
+
+    def sync(self):
+        """Catch the index up with images analyzed or removed since it was saved"""
+        ids, dhashes = analyzed_hashes()
+        indexed = self.index.all_ids()
+        removed = np.setdiff1d(indexed, ids)
+        added = ~np.isin(ids, indexed)
+        if len(removed):
+            # Their pairs are deleted along with the images
+            self.index.remove(removed)
+            self.changed = True
+        if added.any():
+            add_duplicate_pairs(self.check(ids[added], dhashes[added]))
+            self.insert(ids[added], dhashes[added])
+        if self.changed or not self.exists():
+            logger.info(
+                f"Duplicate index synced with {added.sum()} new and {len(removed)} removed"
+            )
+            self.save()
+
+    def check(self, ids: np.ndarray, dhashes: np.ndarray) -> List[dict]:
+        """
+        Find the duplicate pairs new images would add, both
+        against the indexed images and among themselves
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        queries, found, distances = self.index.query(dhashes)
+        pairs = [
+            (
+                np.minimum(ids[queries], found),
+                np.maximum(ids[queries], found),
+                distances,
+            )
+        ]
+        pairs.append(HammingIndex(dhashes, ids, radius=self.max_radius).pairs())
+        first, second, distances = map(np.concatenate, zip(*pairs))
+        return [
+            {"first_id": a, "second_id": b, "distance": distance}
+            for a, b, distance in zip(
+                first.tolist(), second.tolist(), distances.tolist()
+            )
+        ]
+
+    def insert(self, ids: np.ndarray, dhashes: np.ndarray):
+        self.index.insert(dhashes, ids)
+        if len(ids):
+            self.changed = True
+
+    def save(self):
+        """Write the snapshot, unless it already holds every change"""
+        with self._lock:
+            if self.changed or not self.exists():
+                self.index.save(self.snapshot_path())
+                self.changed = False
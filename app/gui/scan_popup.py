@@ -1,39 +1,18 @@
 import PySimpleGUI as sg
 import logging
-import threading
-from math import ceil
 
-from app.analyze import Crawler, Inspector
+from app.analyze import Scanner
 
 logger = logging.getLogger(__name__)
 
 
-class Scanner:
-
-    def __init__(self):
-        self._cancel = False
-        self.crawler = Crawler()
-        self.inspector = Inspector() 
-
-    def cancel(self):
-        self._cancel = True
-        self.crawler.cancel()
-        self.inspector.cancel()
-
-    def scan(self):
-        new_images = self.crawler(600)
-        for _ in range(ceil(new_images / 150)):
-            if self._cancel:
-                break
-            self.inspector(limit=150, batch=50)
-        logger.info(f'Thread {threading.get_ident()} complete for image scans')
-
-
-def popup_scan():
+def popup_scan(full_sync=False):
 
     popup_test = sg.T('Gathering new images...')
     window = sg.Window('', [[popup_test], [sg.Cancel(s=10)]], finalize=True)
-    scanner = Scanner()
+    scanner = Scanner(
+        full_sync, lambda progress: window.write_event_value("-SCAN_PROGRESS-", progress)
+    )
     thread = window.start_thread(lambda: scanner.scan(), "-SCAN_THREAD-")
     logger.info(f'Thread {thread.ident} started for image scans')
 
@@ -43,6 +22,8 @@ def popup_scan():
             logger.info('Image scanning cancelled')
             popup_test.update(value="Canceling...")
             scanner.cancel()
+        elif event == "-SCAN_PROGRESS-" and not scanner._cancel:
+            popup_test.update(value=f'Gathering new images... {values[event].total} found')
         elif event == "-SCAN_THREAD-":
             break
 
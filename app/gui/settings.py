@@ -3,6 +3,7 @@ import webbrowser
 import os
 
 from app.config import config
+from app.duplicates import DuplicateIndex
 
 
 def add_button():
@@ -326,3 +327,46 @@ The app will add any images from your default collection to search data.
             continue
 
     window.close()
+
+
+def popup_duplicate_settings():
+    info_text = """
+Images are compared by a perceptual hash of their content when finding duplicates.
+The radius is how many of the 64 hash bits may differ for images to count as duplicates.
+Zero only matches identical hashes, larger values find more edits and resizes but also more false matches.
+"""
+    info_col = sg.Column([[sg.Frame("", [
+                    [sg.Text(info_text)],
+                ],)]])
+    data_col = sg.Column([[sg.Frame("", [
+                        [sg.Text("Duplicate Radius:"),
+                        sg.Slider(range=(0, DuplicateIndex.max_radius),
+                                default_value=config.core.duplicate_radius,
+                                orientation="h",
+                                key="-DUPLICATE_RADIUS-",
+                                tooltip="Max number of differing hash bits for duplicate images"),
+                        sg.Push()],
+                    ],
+                                    element_justification="left",
+                                    expand_x=True,
+                )
+            ]
+        ],
+        expand_x=True,
+    )
+    button_col = sg.Column([[sg.Button("Ok"), sg.Button("Cancel")]])
+    layout_edit = [[info_col], [data_col], [button_col]]
+
+    window = sg.Window("Duplicate Settings", layout_edit, finalize=True)
+
+    while True:
+        event, values = window.read()
+
+        if event == sg.WINDOW_CLOSED or event == "Cancel":
+            break
+        elif event == "Ok":
+            config.core.duplicate_radius = int(values["-DUPLICATE_RADIUS-"])
+            config.update()
+            break
+
+    window.close()
@@ -0,0 +1,178 @@
+"""
+Disk backed cache for client api responses
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from app.config import config
+
+logger = logging.getLogger(__name__)
+
+# Response headers kept with a cached body, rate limit headers and such are
+# only meaningful for the response that carried them
+CACHED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+
+class CachedSession(requests.Session):
+    """
+    A requests session that caches successful GET responses on disk.
+    `ttls` maps url fragments to how many seconds a matching response is used
+    without asking the server again, the first fragment found in a url applies
+    and urls matching none are always revalidated. Stale responses with an ETag
+    or Last-Modified header are revalidated with a conditional request and reused
+    on a 304. The least recently used responses are dropped once the cache
+    holds more than `max_size` bytes.
+    """
+
+    def __init__(
+        self,
+        ttls: Optional[Dict[str, float]] = None,
+        max_size: int = 64 * 1024 * 1024,
+        cache_dir: Optional[str] = None,
+    ):
+        super().__init__()
+        self.ttls = ttls or {}
+        self.max_size = max_size
+        self.cache_dir = cache_dir or config.core.cache_loc
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size: Optional[int] = None
+
+    def ttl(self, url: str) -> float:
+        for fragment, ttl in self.ttls.items():
+            if fragment in url:
+                return ttl
+        return 0
+
+    def _path(self, url: str) -> str:
+        # Urls can hold api keys so only their hash is kept on disk
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key)
+
+    def _load(self, url: str) -> Optional[dict]:
+        path = self._path(url)
+        try:
+            with open(f"{path}.json") as file:
+                meta = json.load(file)
+            with open(f"{path}.body", "rb") as file:
+                meta["body"] = file.read()
+        except (OSError, ValueError):
+            return None
+        return meta
+
+    def fresh(self, url: str, params: Optional[dict] = None) -> bool:
+        """If a GET for the url can be answered from the cache without a request"""
+        url = requests.Request("GET", url, params=params).prepare().url
+        meta = self._load(url)
+        return meta is not None and time.time() - meta["stored"] < self.ttl(url)
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        if request.method != "GET":
+            return super().send(request, **kwargs)
+
+        cached = self._load(request.url)
+        if cached is not None:
+            if time.time() - cached["stored"] < self.ttl(request.url):
+                self._touch(request.url)
+                return self._response(request, cached, cached["headers"])
+            headers = cached["headers"]
+            if "ETag" in headers:
+                request.headers["If-None-Match"] = headers["ETag"]
+            if "Last-Modified" in headers:
+                request.headers["If-Modified-Since"] = headers["Last-Modified"]
+
+        response = super().send(request, **kwargs)
+        if cached is not None and response.status_code == 304:
+            response.close()
+            self._store(request.url, cached["headers"])
+            headers = {**response.headers, **cached["headers"]}
+            return self._response(request, cached, headers)
+        if response.status_code == 200 and (
+            self.ttl(request.url) > 0
+            or "ETag" in response.headers
+            or "Last-Modified" in response.headers
+        ):
+            headers = {
+                name: response.headers[name]
+                for name in CACHED_HEADERS
+                if name in response.headers
+            }
+            self._store(request.url, headers, response.content)
+        return response
+
+    @staticmethod
+    def _response(
+        request: requests.PreparedRequest, cached: dict, headers: dict
+    ) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = cached["body"]
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.from_cache = True
+        return response
+
+    def _touch(self, url: str):
+        try:
+            os.utime(f"{self._path(url)}.json")
+        except OSError:
+            pass
+
+    def _files(self):
+        with os.scandir(self.cache_dir) as entries:
+            return [entry for entry in entries if entry.is_file()]
+
+    def _store(self, url: str, headers: dict, body: Optional[bytes] = None):
+        """Save a response, or only restart its ttl when there is no new body"""
+        path = self._path(url)
+        meta = json.dumps({"stored": time.time(), "headers": headers})
+        # Written under a temporary name so readers never see half a response
+        temp = f"{path}.{threading.get_ident()}.tmp"
+        if body is not None:
+            with open(temp, "wb") as file:
+                file.write(body)
+            os.replace(temp, f"{path}.body")
+        with open(temp, "w") as file:
+            file.write(meta)
+        os.replace(temp, f"{path}.json")
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry.stat().st_size for entry in self._files())
+            else:
+                self._size += len(body or b"") + len(meta)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """Drop the least recently used responses until the cache is under 90% full"""
+        entries = {}
+        for entry in self._files():
+            key, _, ext = entry.name.partition(".")
+            stat = entry.stat()
+            used, size = entries.get(key, (0, 0))
+            if ext == "json":
+                used = stat.st_mtime
+            entries[key] = (used, size + stat.st_size)
+        self._size = sum(size for _, size in entries.values())
+        for key, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if self._size <= 0.9 * self.max_size:
+                break
+            for ext in ("json", "body"):
+                try:
+                    os.remove(os.path.join(self.cache_dir, f"{key}.{ext}"))
+                except OSError:
+                    pass
+            self._size -= size
+        logger.info(f"Evicted cached responses, {self._size} bytes remain")
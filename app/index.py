@@ -0,0 +1,474 @@
+"""
+Array backed search indexes. These keep their data in compact NumPy arrays
+and answer queries with vectorized scans instead of per item Python calls.
+"""
+
+import json
+import os
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+def _concat_ranges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Concatenate the integer ranges [start, end) into a single index array"""
+    lengths = ends - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+def _write_snapshot(path: str, records: np.ndarray, meta: dict):
+    """
+    Save snapshot records with their json sidecar. They are written to temp files
+    first, named per process and thread so concurrent writers never share one,
+    and a crash never leaves a partial snapshot.
+    """
+    temp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    np.save(f"{temp}.npy", records)
+    with open(f"{temp}.json", "w") as fobj:
+        json.dump(meta, fobj)
+    os.replace(f"{temp}.npy", f"{path}.npy")
+    os.replace(f"{temp}.json", f"{path}.json")
+
+
+class NearestIndex:
+    """
+    Find the k nearest points, by euclidean distance, to a batch of query points.
+    Each point carries an integer id which is what queries return.
+    Moderate sized sets are scanned brute force in memory bounded blocks.
+    Large 3d sets, like Lab colors, are bucketed into a uniform grid so a query
+    only scans the cells around it.
+
+    Points can be inserted and removed without a rebuild. New points are kept
+    in a small side buffer and removed points are masked out, both are folded
+    into the main arrays once they grow past `merge_ratio` of the index.
+    """
+
+    # Above this many points 3d sets are searched through the grid
+    grid_threshold = 250_000
+    # Number of coordinate differences held in memory at once when scanning
+    block_size = 2**22
+    # Share of pending inserts or removals that triggers a compaction
+    merge_ratio = 0.1
+
+    def __init__(
+        self,
+        points: np.ndarray,
+        ids: Optional[np.ndarray] = None,
+        cell_size: float = 4.0,
+    ):
+        points = np.asarray(points, dtype=np.float32)
+        points = points.reshape(-1, points.shape[-1])
+        if ids is None:
+            ids = np.arange(len(points))
+        self.cell_size = cell_size
+        self._set(points, np.asarray(ids, dtype=np.int64))
+
+    def _set(self, points: np.ndarray, ids: np.ndarray):
+        self.points = points
+        self.ids = ids
+        self._alive = np.ones(len(points), dtype=bool)
+        self._removed = 0
+        self._new_points = np.empty((0, self.dims), dtype=np.float32)
+        self._new_ids = np.empty(0, dtype=np.int64)
+        self._grid = False
+        if len(self.points) > self.grid_threshold and self.dims == 3:
+            self._build_grid()
+
+    def __len__(self) -> int:
+        return len(self.points) - self._removed + len(self._new_points)
+
+    @property
+    def dims(self) -> int:
+        return self.points.shape[1]
+
+    def insert(self, points: np.ndarray, ids: np.ndarray):
+        """Add points with their ids to the index"""
+        points = np.asarray(points, dtype=np.float32).reshape(-1, self.dims)
+        self._new_points = np.concatenate((self._new_points, points))
+        self._new_ids = np.concatenate((self._new_ids, np.asarray(ids, np.int64)))
+        if len(self._new_points) > self.merge_ratio * len(self.points):
+            self.compact()
+
+    def remove(self, ids: np.ndarray):
+        """Remove any points with the given ids from the index"""
+        ids = np.asarray(ids, dtype=np.int64)
+        self._alive &= ~np.isin(self.ids, ids)
+        self._removed = len(self._alive) - int(self._alive.sum())
+        keep = ~np.isin(self._new_ids, ids)
+        self._new_points = self._new_points[keep]
+        self._new_ids = self._new_ids[keep]
+        if self._removed > self.merge_ratio * len(self.points):
+            self.compact()
+
+    def compact(self):
+        """Fold pending inserts and removals into the main arrays"""
+        points = np.concatenate((self.points[self._alive], self._new_points))
+        ids = np.concatenate((self.ids[self._alive], self._new_ids))
+        self._set(points, ids)
+
+    def save(self, path: str, **meta):
+        """
+        Write the index to a memory mappable `.npy` snapshot with a json sidecar
+        holding any extra metadata, like the library generation it reflects.
+        """
+        self.compact()
+        records = np.empty(
+            len(self.points), dtype=[("point", "<f4", (self.dims,)), ("id", "<i8")]
+        )
+        records["point"] = self.points
+        records["id"] = self.ids
+        meta = {**meta, "cell_size": self.cell_size, "size": len(records)}
+        _write_snapshot(path, records, meta)
+
+    @classmethod
+    def load(cls, path: str) -> Tuple[Optional["NearestIndex"], dict]:
+        """
+        Load an index snapshot written with `save`, the arrays are memory mapped.
+        Returns the index and its metadata, or None and {} if there is no valid snapshot.
+        """
+        try:
+            with open(f"{path}.json") as fobj:
+                meta = json.load(fobj)
+            records = np.load(f"{path}.npy", mmap_mode="r")
+        except (OSError, ValueError):
+            return None, {}
+        if len(records) != meta.get("size"):
+            return None, {}
+        index = cls.__new__(cls)
+        index.cell_size = meta["cell_size"]
+        index._set(records["point"], records["id"])
+        return index, meta
+
+    def query(self, points: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the k nearest indexed points for each of the given points.
+        Returns (m, k) arrays of distances and point ids, nearest first.
+        """
+        points = np.asarray(points, dtype=np.float32).reshape(-1, self.dims)
+        k = min(k, len(self))
+        distances = np.empty((len(points), 0), dtype=np.float32)
+        found = np.empty((len(points), 0), dtype=np.int64)
+        if k == 0:
+            return distances, found
+
+        main_k = min(k, len(self.points) - self._removed)
+        if main_k and self._grid:
+            results = [self._grid_query(point, main_k) for point in points]
+            distances, found = map(np.stack, zip(*results))
+        elif main_k:
+            alive = self._alive if self._removed else None
+            distances, found = self._scan(points, self.points, main_k, alive)
+        found = self.ids[found]
+
+        if len(self._new_points):
+            new_k = min(k, len(self._new_points))
+            new_distances, new_found = self._scan(points, self._new_points, new_k)
+            distances = np.concatenate((distances, new_distances), axis=1)
+            found = np.concatenate((found, self._new_ids[new_found]), axis=1)
+            order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+            distances = np.take_along_axis(distances, order, axis=1)
+            found = np.take_along_axis(found, order, axis=1)
+        return distances, found
+
+    def _scan(
+        self,
+        queries: np.ndarray,
+        candidates: np.ndarray,
+        k: int,
+        alive: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Brute force k nearest candidate positions for each query"""
+        step = max(1, self.block_size // max(candidates.size, 1))
+        distances = []
+        indexes = []
+        for start in range(0, len(queries), step):
+            block = queries[start : start + step]
+            # Direct differences avoid the precision loss of the expanded form
+            dist = np.sqrt(
+                ((block[:, None, :] - candidates[None, :, :]) ** 2).sum(axis=2)
+            )
+            if alive is not None:
+                dist[:, ~alive] = np.inf
+            nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            nearest_dist = np.take_along_axis(dist, nearest, axis=1)
+            order = np.argsort(nearest_dist, axis=1, kind="stable")
+            distances.append(np.take_along_axis(nearest_dist, order, axis=1))
+            indexes.append(np.take_along_axis(nearest, order, axis=1))
+        return np.concatenate(distances), np.concatenate(indexes)
+
+    def _build_grid(self):
+        self._origin = self.points.min(axis=0)
+        coords = ((self.points - self._origin) // self.cell_size).astype(np.int64)
+        self._shape = coords.max(axis=0) + 1
+        cells = np.ravel_multi_index(coords.T, self._shape)
+        # Points are kept sorted by cell so each cell is a contiguous slice.
+        # Snapshots are saved in this order so loading one skips the sort.
+        if (np.diff(cells) < 0).any():
+            order = np.argsort(cells, kind="stable")
+            self.points = self.points[order]
+            self.ids = self.ids[order]
+            cells = cells[order]
+        counts = np.bincount(cells, minlength=int(np.prod(self._shape)))
+        self._starts = np.concatenate(([0], np.cumsum(counts)))
+        self._grid = True
+
+    def _grid_query(self, point: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        cell = np.floor((point - self._origin) / self.cell_size).astype(np.int64)
+        radius = 0
+        while True:
+            low = np.maximum(cell - radius, 0)
+            high = np.minimum(cell + radius, self._shape - 1)
+            covers_grid = (low == 0).all() and (high == self._shape - 1).all()
+            if (low <= high).all():
+                axes = [np.arange(lo, hi + 1) for lo, hi in zip(low, high)]
+                block = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1)
+                cells = np.ravel_multi_index(block.reshape(-1, 3).T, self._shape)
+                candidates = _concat_ranges(
+                    self._starts[cells], self._starts[cells + 1]
+                )
+                if self._removed:
+                    candidates = candidates[self._alive[candidates]]
+                if len(candidates) >= k:
+                    distances, nearest = self._scan(
+                        point[None, :], self.points[candidates], k
+                    )
+                    # Anything outside the searched cells is at least
+                    # `radius` cells away so these results are final
+                    if distances[0, -1] <= radius * self.cell_size or covers_grid:
+                        return distances[0], candidates[nearest[0]]
+            radius += 1
+
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    """
+    Count the set bits of each value in a uint64 array.
+    numpy<2 has no popcount ufunc so this uses the parallel bit counting trick,
+    summing bits in pairs, nibbles and then bytes without leaving uint64 math.
+    """
+    x = np.asarray(values, dtype=np.uint64)
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + (
+        (x >> np.uint64(2)) & np.uint64(0x3333333333333333)
+    )
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((x * np.uint64(0x0101010101010101)) >> np.uint64(56)).view(np.int64)
+
+
+class HammingIndex:
+    """
+    Find 64 bit hashes within a hamming radius of each other with multi-index hashing.
+    Hashes are split into `radius + 1` bands, and by the pigeonhole principle two
+    hashes within the radius are equal on at least one band. Only hashes sharing
+    a band value are compared, with a popcount over their xor to verify them.
+
+    Like `NearestIndex`, hashes can be inserted and removed without rebuilding the
+    band tables. New hashes are scanned brute force from a side buffer and removed
+    ones are masked out until they grow past `merge_ratio` of the index.
+    """
+
+    # Number of hash comparisons held in memory at once when scanning new hashes
+    block_size = 2**22
+    # Share of pending inserts or removals that triggers a compaction
+    merge_ratio = 0.1
+
+    def __init__(
+        self,
+        hashes: np.ndarray,
+        ids: Optional[np.ndarray] = None,
+        radius: int = 1,
+    ):
+        hashes = np.asarray(hashes, dtype=np.uint64).reshape(-1)
+        if ids is None:
+            ids = np.arange(len(hashes))
+        self.radius = radius
+        self._set(hashes, np.asarray(ids, dtype=np.int64))
+
+    def _set(self, hashes: np.ndarray, ids: np.ndarray, orders=None):
+        self.hashes = hashes
+        self.ids = ids
+        # Each band is kept as sorted keys with the hash positions in that order
+        if orders is None:
+            orders = [
+                np.argsort(self._band_keys(hashes, band), kind="stable")
+                for band in range(self.radius + 1)
+            ]
+        self._orders = orders
+        self._keys = [
+            self._band_keys(hashes[order], band) for band, order in enumerate(orders)
+        ]
+        self._alive = np.ones(len(hashes), dtype=bool)
+        self._removed = 0
+        self._new_hashes = np.empty(0, dtype=np.uint64)
+        self._new_ids = np.empty(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.hashes) - self._removed + len(self._new_hashes)
+
+    @property
+    def bands(self) -> List[Tuple[int, int]]:
+        """The 64 bits split into `radius + 1` near equal (shift, mask) bands"""
+        count = self.radius + 1
+        widths = [64 // count + (i < 64 % count) for i in range(count)]
+        shifts = np.concatenate(([0], np.cumsum(widths)[:-1]))
+        return [(int(shift), (1 << width) - 1) for shift, width in zip(shifts, widths)]
+
+    def _band_keys(self, hashes: np.ndarray, band: int) -> np.ndarray:
+        shift, mask = self.bands[band]
+        return (hashes >> np.uint64(shift)) & np.uint64(mask)
+
+    def insert(self, hashes: np.ndarray, ids: np.ndarray):
+        """Add hashes with their ids to the index"""
+        hashes = np.asarray(hashes, dtype=np.uint64).reshape(-1)
+        self._new_hashes = np.concatenate((self._new_hashes, hashes))
+        self._new_ids = np.concatenate((self._new_ids, np.asarray(ids, np.int64)))
+        if len(self._new_hashes) > self.merge_ratio * len(self.hashes):
+            self.compact()
+
+    def remove(self, ids: np.ndarray):
+        """Remove any hashes with the given ids from the index"""
+        ids = np.asarray(ids, dtype=np.int64)
+        self._alive &= ~np.isin(self.ids, ids)
+        self._removed = len(self._alive) - int(self._alive.sum())
+        keep = ~np.isin(self._new_ids, ids)
+        self._new_hashes = self._new_hashes[keep]
+        self._new_ids = self._new_ids[keep]
+        if self._removed > self.merge_ratio * len(self.hashes):
+            self.compact()
+
+    def compact(self):
+        """Fold pending inserts and removals into the band tables"""
+        if not self._removed and not len(self._new_hashes):
+            return
+        hashes = np.concatenate((self.hashes[self._alive], self._new_hashes))
+        ids = np.concatenate((self.ids[self._alive], self._new_ids))
+        self._set(hashes, ids)
+
+    def all_ids(self) -> np.ndarray:
+        """Ids of every hash in the index"""
+        return np.concatenate((self.ids[self._alive], self._new_ids))
+
+    def save(self, path: str, **meta):
+        """
+        Write the index, band tables included, to a memory mappable `.npy`
+        snapshot with a json sidecar holding any extra metadata.
+        """
+        self.compact()
+        # Windows can't replace a file that is still mapped, so arrays
+        # loaded from a snapshot are read into memory before saving over it
+        if isinstance(self.hashes.base, np.memmap):
+            orders = [np.array(order) for order in self._orders]
+            self._set(np.array(self.hashes), np.array(self.ids), orders)
+        records = np.empty(
+            len(self.hashes),
+            dtype=[
+                ("hash", "<u8"),
+                ("id", "<i8"),
+                ("order", "<i8", (self.radius + 1,)),
+            ],
+        )
+        records["hash"] = self.hashes
+        records["id"] = self.ids
+        records["order"] = np.stack(self._orders, axis=1)
+        meta = {**meta, "radius": self.radius, "size": len(records)}
+        _write_snapshot(path, records, meta)
+
+    @classmethod
+    def load(cls, path: str) -> Tuple[Optional["HammingIndex"], dict]:
+        """
+        Load an index snapshot written with `save`, the arrays are memory mapped.
+        Returns the index and its metadata, or None and {} if there is no valid snapshot.
+        """
+        try:
+            with open(f"{path}.json") as fobj:
+                meta = json.load(fobj)
+            records = np.load(f"{path}.npy", mmap_mode="r")
+        except (OSError, ValueError):
+            return None, {}
+        if len(records) != meta.get("size"):
+            return None, {}
+        index = cls.__new__(cls)
+        index.radius = meta["radius"]
+        index._set(records["hash"], records["id"], list(records["order"].T))
+        return index, meta
+
+    def query(
+        self, hashes: np.ndarray, radius: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Find every indexed hash within `radius` bits of each of the given hashes.
+        Returns arrays of the query positions, the matching ids and their distances.
+        """
+        radius = self.radius if radius is None else min(radius, self.radius)
+        hashes = np.asarray(hashes, dtype=np.uint64).reshape(-1)
+        found = [(np.empty(0, np.int64),) * 3]
+        query_keys = [self._band_keys(hashes, band) for band in range(len(self._keys))]
+        for band, (keys, order) in enumerate(zip(self._keys, self._orders)):
+            starts = np.searchsorted(keys, query_keys[band], side="left")
+            ends = np.searchsorted(keys, query_keys[band], side="right")
+            queries = np.repeat(np.arange(len(hashes)), ends - starts)
+            positions = order[_concat_ranges(starts, ends)]
+            distances = popcount(self.hashes[positions] ^ hashes[queries])
+            keep = (distances <= radius) & self._alive[positions]
+            # A match equal on an earlier band was already found there
+            for earlier in range(band):
+                keep &= query_keys[earlier][queries] != self._band_keys(
+                    self.hashes[positions], earlier
+                )
+            found.append((queries[keep], self.ids[positions[keep]], distances[keep]))
+
+        step = max(1, self.block_size // max(len(self._new_hashes), 1))
+        for start in range(0, len(hashes) if len(self._new_hashes) else 0, step):
+            block = hashes[start : start + step]
+            distances = popcount(
+                (block[:, None] ^ self._new_hashes[None, :]).reshape(-1)
+            ).reshape(len(block), -1)
+            queries, positions = np.nonzero(distances <= radius)
+            found.append(
+                (
+                    queries + start,
+                    self._new_ids[positions],
+                    distances[queries, positions],
+                )
+            )
+        queries, ids, distances = map(np.concatenate, zip(*found))
+        return queries, ids, distances
+
+    def pairs(
+        self, radius: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Find every pair of indexed hashes within `radius` bits of each other.
+        Returns arrays of the first ids, second ids and their distances.
+        """
+        radius = self.radius if radius is None else min(radius, self.radius)
+        self.compact()
+        found = [(np.empty(0, np.int64),) * 3]
+        for band, (sorted_keys, order) in enumerate(zip(self._keys, self._orders)):
+            # Exclusive end of the run of equal keys each sorted position is in
+            starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+            sizes = np.diff(np.r_[starts, len(sorted_keys)])
+            ends = np.repeat(starts + sizes, sizes)
+
+            # Compare each position to the ones `step` after it in the same run,
+            # the work is the number of candidate pairs rather than n squared
+            positions = np.arange(len(sorted_keys))
+            step = 1
+            while True:
+                positions = positions[positions + step < ends[positions]]
+                if not len(positions):
+                    break
+                a, b = order[positions], order[positions + step]
+                distances = popcount(self.hashes[a] ^ self.hashes[b])
+                keep = distances <= radius
+                # A pair equal on an earlier band was already found there
+                for earlier in range(band):
+                    keep &= self._band_keys(self.hashes[a], earlier) != self._band_keys(
+                        self.hashes[b], earlier
+                    )
+                a, b = self.ids[a[keep]], self.ids[b[keep]]
+                found.append((np.minimum(a, b), np.maximum(a, b), distances[keep]))
+                step += 1
+        first, second, distances = map(np.concatenate, zip(*found))
+        return first, second, distances
@@ -1,172 +1,389 @@
 import logging
-from collections import defaultdict
-from math import sqrt
-from typing import Dict, List, Optional, Tuple
+import os
+import sys
+from collections import OrderedDict, defaultdict
+from itertools import chain, zip_longest
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
-import vptree
-from colormath.color_conversions import convert_color
-from colormath.color_objects import LabColor, sRGBColor
-from sqlalchemy.orm import Query
+import numpy as np
 
+from app.colors import FEATURE_SIZE, N_BINS, bin_to_lab, hex_to_bin, hex_to_lab
+from app.config import config
 from app.db import (
     QueryDict,
-    Wallpaper,
+    WallpaperListing,
     WallpaperQuery,
-    all_colors,
-    create_session,
-    wallpaper_by_id,
+    color_bins,
+    colors_since,
+    duplicate_pairs,
+    feature_vectors,
+    features_since,
+    library_generation,
+    library_state,
+    wallpaper_resolutions,
 )
+from app.duplicates import DuplicateIndex, analyzed_hashes
+from app.index import NearestIndex, popcount
 
 logger = logging.getLogger(__name__)
 
 
 class ColorSearch:
     """
-    Find the closest n colors to a given color in the database
-    An interesting process of using the LAB colorspace and a vantage
-    point tree for fast and accurate distance searching.
+    Find the closest n color bins to a given color in the database
+    Palettes are quantized to a fixed Lab color vocabulary, see `app.colors`,
+    so the searched set stays bounded however many images are in the library.
+    The occupied bins are compared in the LAB colorspace through an array backed
+    nearest neighbor index, which is kept in a snapshot file and only updated
+    with the colors that changed since it was saved.
     """
 
     def __init__(self) -> None:
         self.reload()
 
+    @property
+    def snapshot_path(self) -> str:
+        return os.path.join(os.path.dirname(config.core.db_loc), "color_index")
+
+    @property
+    def loaded(self) -> bool:
+        return len(self.index) > 0
+
     def reload(self):
-        """Load searchable color tree with known db colors"""
-        colors = [self.hex_to_lab(val) for val in self.known_colors()]
-        if colors:
-            self.loaded = True
-            self.vptree = vptree.VPTree(colors, self.euclidean)
-        else:
-            self.loaded = False
-
-    # TODO: This could potentially get very large and
-    # may need to be updated if new images are added
-    def known_colors(self) -> List[int]:
-        return tuple(color[0] for color in all_colors())
-
-    @staticmethod
-    def hex_to_lab(hex_value: int) -> Tuple[float, float, float]:
-        """Convert a hex color to a lab colorspace"""
-        red, green, blue = (
-            (hex_value >> 16) & 0xFF,
-            (hex_value >> 8) & 0xFF,
-            hex_value & 0xFF,
+        """Load the color index snapshot, or start a new one, and bring it up to date"""
+        self.index, meta = NearestIndex.load(self.snapshot_path)
+        # Snapshots of a different color vocabulary can't be reused
+        if self.index is None or meta.get("bins") != N_BINS:
+            self.index, meta = NearestIndex(np.empty((0, 3))), {}
+        self.generation = meta.get("generation", -1)
+        self.watermark = meta.get("watermark", 0)
+        self.removals = meta.get("removals", 0)
+        # Lookup table of which color bins are indexed
+        self._indexed = np.zeros(N_BINS, dtype=bool)
+        self._indexed[self.index.ids] = True
+        self.refresh()
+
+    def refresh(self):
+        """Update the color index with any bins added or removed since it was built"""
+        generation = library_generation()
+        if generation == self.generation:
+            return
+        removals = library_state("removals")
+
+        stale = np.empty(0, dtype=np.int64)
+        colors, watermark = colors_since(self.watermark)
+        bins = np.unique(hex_to_bin(colors)) if colors else np.empty(0, np.int64)
+        if removals != self.removals:
+            # Removed images may have emptied bins so the
+            # whole index is compared against the db
+            bins = np.array(color_bins(), dtype=np.int64)
+            in_db = np.zeros(N_BINS, dtype=bool)
+            in_db[bins] = True
+            stale = np.flatnonzero(self._indexed & ~in_db)
+        added = bins[~self._indexed[bins]]
+
+        if len(stale):
+            self.index.remove(stale)
+            self._indexed[stale] = False
+        if len(added):
+            self.index.insert(bin_to_lab(added), added)
+            self._indexed[added] = True
+        logger.info(
+            f"Color index updated with {len(added)} new and {len(stale)} removed bins"
         )
-        color = sRGBColor(red, green, blue, is_upscaled=True)
-        return convert_color(color, LabColor).get_value_tuple()
-
-    @staticmethod
-    def lab_to_hex(lab_values: Tuple[float, float, float]) -> int:
-        """Convert lab values to a friendly hex string of the form #AABBCC"""
-        # Incoming sRGBColor values had a default illumination of `d65`
-        # https://python-colormath.readthedocs.io/en/latest/color_objects.html#colormath.color_objects.sRGBColor.native_illuminant
-        l, a, b = lab_values
-        color = convert_color(LabColor(l, a, b, illuminant="d65"), sRGBColor)
-        r, g, b = color.get_upscaled_value_tuple()
-        return r << 16 | g << 8 | b
-
-    @staticmethod
-    def euclidean(p1: Tuple[float], p2: Tuple[float]) -> float:
-        return sqrt(sum(((v2 - v1) ** 2) for v1, v2 in zip(p1, p2)))
-
-    def __call__(self, color: str, n_colors: int = 20) -> List[int]:
-        """Find the n closest colors in the db to a given color"""
-        color = self.hex_to_lab(int(color.strip("#"), 16))
-        # First return value are the search scores and are not needed
-        if self.loaded:
-            _, labs = zip(*self.vptree.get_n_nearest_neighbors(color, n_colors))
-            return [self.lab_to_hex(lab) for lab in labs]
-        else:
+
+        self.generation, self.watermark, self.removals = generation, watermark, removals
+        # Lookups are memoized per picked color until the index changes
+        self._nearest = {}
+        self.index.save(
+            self.snapshot_path,
+            bins=N_BINS,
+            generation=generation,
+            watermark=watermark,
+            removals=removals,
+        )
+
+    def nearest(self, colors: List[str], n_colors: int = 20) -> List[Dict[int, float]]:
+        """
+        Find the n closest used color bins for each of the given hex color strings.
+        Returns a mapping of each found bin to its distance per given color.
+        """
+        labs = hex_to_lab([int(color.strip("#"), 16) for color in colors])
+        distances, found = self.index.query(labs, n_colors)
+        return [
+            dict(zip(ids.tolist(), dist.tolist()))
+            for dist, ids in zip(distances, found)
+        ]
+
+    def __call__(self, color: str, n_colors: int = 20) -> Optional[Dict[int, float]]:
+        """
+        Find the n closest used color bins to a given color.
+        Returns a mapping of each bin to its distance from the given color.
+        """
+        if not self.loaded:
             return None
+        key = (color.lower(), n_colors)
+        if key not in self._nearest:
+            self._nearest[key] = self.nearest([color], n_colors)[0]
+        return self._nearest[key]
+
+
+class DisjointSets:
+    """Union find over integer ids, merged by size with path halving"""
+
+    def __init__(self) -> None:
+        self.parent: Dict[int, int] = {}
+        self.size: Dict[int, int] = {}
+
+    def find(self, item: int) -> int:
+        parent = self.parent.setdefault(item, item)
+        while parent != item:
+            grandparent = self.parent[parent]
+            self.parent[item] = grandparent
+            item, parent = grandparent, self.parent[grandparent]
+        return item
+
+    def union(self, a: int, b: int):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self.size.get(a, 1) < self.size.get(b, 1):
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] = self.size.get(a, 1) + self.size.pop(b, 1)
+
+    def groups(self) -> List[List[int]]:
+        """Every set with more than one member"""
+        members = defaultdict(list)
+        for item in self.parent:
+            members[self.find(item)].append(item)
+        return [group for group in members.values() if len(group) > 1]
 
 
 class DuplicateSearch:
     """
     Find duplicate images in the database.
     A process of using a interesting perceptual hash (dhash)
-    and a vantage point tree. Scale invariant!
+    and multi-index hashing to find close hashes. Scale invariant!
     """
 
-    @staticmethod
-    def hamming(a: int, b: int) -> int:
-        """Find the hamming distance between two integers"""
-        return bin(int(a) ^ int(b)).count("1")
-
-    @property
-    def id_to_dhash(self) -> dict:
-        with create_session() as session:
-            query = (
-                session.query(Wallpaper.id, Wallpaper.dhash)
-                .filter(Wallpaper.dhash != None)
-                .all()
-            )
-        return {_id: _dhash for _id, _dhash in query}
-
-    def similar(self, _id: int) -> List[int]:
-        """Find images that are similar to a given image id"""
+    def __init__(self) -> None:
+        self.generation = -1
+        self.ids = np.empty(0, dtype=np.int64)
+        self.dhashes = np.empty(0, dtype=np.uint64)
+
+    def hashes(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Sorted arrays of the ids and 64 bit dhash values of all analyzed images.
+        These are cached until the library changes.
+        """
+        generation = library_generation()
+        if generation != self.generation:
+            self.ids, self.dhashes = analyzed_hashes()
+            self.generation = generation
+        return self.ids, self.dhashes
+
+    def similar(self, _id: int, n_images: int = 20) -> List[int]:
+        """Find images that are similar to a given image id, the most similar first"""
 
         # TODO: I'm not terribly sure how great this works.
         # By observation it kinda works but there are other ways
         # comparisons could be done like with histograms.
         # Would be interesting to investigate it a bit
 
-        dhash = wallpaper_by_id(_id).dhash
-        dhash_to_id = {}
-        duplicates = defaultdict(list)
-
-        for _id, _dhash in self.id_to_dhash.items():
-            if _dhash in dhash_to_id:
-                duplicates[dhash_to_id[_dhash]].append(_id)
-            else:
-                dhash_to_id[_dhash] = _id
-
-        search_tree = vptree.VPTree(list(dhash_to_id.keys()), self.hamming)
-
-        results = search_tree.get_n_nearest_neighbors(dhash, 20)
-        results = sorted(results)
-        ids = []
-        for _, _hash in results:
-            ids.append(dhash_to_id.get(_hash))
-        return ids
-
-    def duplicates(self) -> Dict[int, List[int]]:
-        """Find duplicated images in the database"""
-        # Build a mapping of ids to image hashes for searching and
-        # find early duplicates by matching the hash exactly
-        dhash_to_id = {}
-        duplicates = defaultdict(list)
-
-        for _id, _dhash in self.id_to_dhash.items():
-            if _dhash in dhash_to_id:
-                duplicates[dhash_to_id[_dhash]].append(_id)
-            else:
-                dhash_to_id[_dhash] = _id
-
-        # Load a vantage point tree with a hamming distance search indexer
-        search_tree = vptree.VPTree(list(dhash_to_id.keys()), self.hamming)
-
-        # Find similar hashes for each image
-        for search_hash, search_id in dhash_to_id.items():
-            results = search_tree.get_all_in_range(search_hash, 1)
-            results = sorted(results)
-            similar_ids = [
-                dhash_to_id.get(_hash)
-                for distance, _hash in results
-                if _hash != search_hash
-            ]
-
-            if similar_ids:
-                duplicates[search_id].extend(similar_ids)
-
-        # Mark single images as duplicates
-        to_mark = []
-        check = {}
-        for found_duplicate, related_duplicates in duplicates.items():
-            if found_duplicate not in to_mark:
-                to_mark += related_duplicates
-                check[found_duplicate] = related_duplicates
-
-        return check
+        ids, dhashes = self.hashes()
+        position = np.searchsorted(ids, _id)
+        if position == len(ids) or ids[position] != _id:
+            return []
+        return [_id for _id, _ in self.nearest(int(dhashes[position]), n_images)]
+
+    def nearest(self, dhash: int, n_images: int = 20) -> List[Tuple[int, int]]:
+        """Find the ids and hamming distances of the n images closest to a dhash"""
+        ids, dhashes = self.hashes()
+        if not len(ids):
+            return []
+        # One vectorized pass over every hash and a partial sort for the top n
+        distances = popcount(dhashes ^ np.uint64(dhash))
+        n_images = min(n_images, len(ids))
+        nearest = np.argpartition(distances, n_images - 1)[:n_images]
+        nearest = nearest[np.lexsort((ids[nearest], distances[nearest]))]
+        return list(zip(ids[nearest].tolist(), distances[nearest].tolist()))
+
+    def groups(
+        self, radius: Optional[int] = None, page_size: int = 50
+    ) -> Iterator[List[List[int]]]:
+        """
+        Stream pages of duplicate image groups, images within `radius` bits of
+        hamming distance of each other are treated as duplicates. Groups are
+        disjoint and lead with their highest resolution image. Each page holds
+        whole groups of up to `page_size` images, larger groups are split over
+        several pages.
+        """
+        if radius is None:
+            radius = config.core.duplicate_radius
+        # Pairs are kept up to date by the Inspector, only a library
+        # analyzed before the index existed needs a first full pass
+        if not DuplicateIndex.exists():
+            DuplicateIndex()
+
+        clusters = DisjointSets()
+        for a, b, _ in duplicate_pairs(radius):
+            clusters.union(a, b)
+        groups = sorted(clusters.groups(), key=min)
+        resolutions = wallpaper_resolutions(clusters.parent)
+
+        page = []
+        for group in groups:
+            group.sort(key=lambda _id: (-resolutions.get(_id, 0), _id))
+            for start in range(0, len(group), page_size):
+                chunk = group[start : start + page_size]
+                if page and sum(map(len, page)) + len(chunk) > page_size:
+                    yield page
+                    page = []
+                page.append(chunk)
+        if page:
+            yield page
+
+    def duplicates(self, radius: Optional[int] = None) -> Dict[int, List[int]]:
+        """Map the representative image of each duplicate group to the rest of it"""
+        return {
+            group[0]: group[1:]
+            for page in self.groups(radius, page_size=sys.maxsize)
+            for group in page
+        }
+
+
+class FeatureSearch:
+    """
+    Find images that look alike by their color histogram feature vectors.
+    This catches images with a similar look that are not near copies, which
+    the dhash based `DuplicateSearch.similar` would miss. Vectors are cached
+    as a matrix in a brute force `NearestIndex` which is topped up with the
+    vectors saved since it was last used.
+    """
+
+    def __init__(self) -> None:
+        self.generation = -1
+        self.watermark = 0
+        self.removals = -1
+        self.index = NearestIndex(np.empty((0, FEATURE_SIZE)))
+
+    def refresh(self):
+        """Add any feature vectors saved since the last search"""
+        generation = library_generation()
+        if generation == self.generation:
+            return
+        removals = library_state("removals")
+        if removals != self.removals:
+            # Removed images may still be cached so the matrix is reloaded
+            self.index = NearestIndex(np.empty((0, FEATURE_SIZE)))
+            self.watermark = 0
+        rows, self.watermark = features_since(self.watermark)
+        if rows:
+            ids, vectors = zip(*rows)
+            self.index.insert(as_vectors(vectors), ids)
+        self.generation, self.removals = generation, removals
+
+    def similar(self, ids: List[int], n_images: int = 20) -> List[int]:
+        """
+        Find the images that look most like any of the given images, the most
+        alike first. The given images are included as they match themselves.
+        """
+        return self.nearest(feature_vectors(ids).values(), n_images)
+
+    def nearest(self, vectors: Iterable[bytes], n_images: int = 20) -> List[int]:
+        """Find the images closest to any of the given feature vectors"""
+        self.refresh()
+        vectors = list(vectors)
+        if not vectors or not len(self.index):
+            return []
+        distances, found = self.index.query(as_vectors(vectors), n_images)
+        # Keep the closest match of each image over all of the searched ones
+        nearest = {}
+        for distance, _id in sorted(
+            zip(distances.ravel().tolist(), found.ravel().tolist())
+        ):
+            nearest.setdefault(_id, distance)
+        return list(nearest)[:n_images]
+
+
+def as_vectors(vectors: Iterable[bytes]) -> np.ndarray:
+    """Stack stored feature vector blobs into a float matrix"""
+    vectors = list(vectors)
+    matrix = np.frombuffer(b"".join(vectors), dtype=np.uint8)
+    return matrix.reshape(len(vectors), FEATURE_SIZE).astype(np.float32)
+
+
+class ImageMatches(NamedTuple):
+    # Images within the duplicate radius of the searched image
+    duplicates: List[int]
+    # Images with close dhashes, then the closest by color histogram and by palette
+    similar: List[int]
+    look_alikes: List[int]
+    palette: List[int]
+
+    @property
+    def ids(self) -> List[int]:
+        """
+        All matches without repeats. Close dhashes come first, followed by the
+        look alike and palette matches taking turns so both kinds are shown.
+        """
+        taking_turns = chain.from_iterable(zip_longest(self.look_alikes, self.palette))
+        ids = chain(self.similar, (_id for _id in taking_turns if _id is not None))
+        return list(dict.fromkeys(ids))
+
+
+class ImageSearch:
+    """
+    Match an image from outside of the library against the cached search indexes.
+    This shows whether an image, or something close to it, is already saved
+    without adding it and waiting on a scan.
+    """
+
+    def __init__(
+        self,
+        color_search: ColorSearch,
+        dupes: DuplicateSearch,
+        look_alikes: FeatureSearch,
+    ) -> None:
+        self.color_search = color_search
+        self.dupes = dupes
+        self.look_alikes = look_alikes
+
+    def __call__(
+        self,
+        entry: dict,
+        colors: List[int],
+        feature: bytes,
+        n_images: int = 20,
+        n_colors: int = 3,
+    ) -> ImageMatches:
+        """Find matches for the results of `app.analyze.analyze_image`"""
+        # Hashes further apart than any tracked duplicate pair are mostly noise
+        similar = [
+            (_id, distance)
+            for _id, distance in self.dupes.nearest(int(entry["dhash"]), n_images)
+            if distance <= DuplicateIndex.max_radius
+        ]
+        radius = config.core.duplicate_radius
+        duplicates = [_id for _id, distance in similar if distance <= radius]
+        look_alikes = self.look_alikes.nearest([feature], n_images)
+
+        # The most prominent palette colors are searched together
+        self.color_search.refresh()
+        bins = {}
+        palette = []
+        if self.color_search.loaded and colors:
+            searched = [f"#{color:06x}" for color in colors[:n_colors]]
+            for nearest in self.color_search.nearest(searched):
+                for _bin, distance in nearest.items():
+                    bins[_bin] = min(distance, bins.get(_bin, distance))
+            query = WallpaperQuery({"colors": bins})
+            palette = [listing.id for listing in query(limit=n_images)]
+
+        return ImageMatches(
+            duplicates, [_id for _id, _ in similar], look_alikes, palette
+        )
 
 
 class Search:
@@ -174,12 +391,37 @@ class Search:
 
     limit = 20
     query_data = QueryDict()
+    # Number of distinct searches to keep results for
+    cache_size = 32
 
     def __init__(self) -> None:
         self.color_search = ColorSearch()
+        self.generation = library_generation()
+        self._results = OrderedDict()
 
-    def parse_query(self, query: Query) -> Tuple[Tuple[int, str, str], List[str]]:
-        """Evaluate a query and split the results into metadata and image sources"""
+    def reload(self):
+        """Update the color search and drop cached results after library changes"""
+        self.color_search.refresh()
+        self._results.clear()
+        self.generation = library_generation()
+
+    def cache_key(self, offset: int = 0) -> tuple:
+        """Normalize the search params so equivalent searches share results"""
+        ids, colors = self.ids, self.colors
+        source_types = self.source_types
+        return (
+            None if ids is None else tuple(ids),
+            None if colors is None else tuple(sorted(colors.items())),
+            None if source_types is None else tuple(sorted(set(source_types))),
+            self.aspect_ratio,
+            self.limit,
+            offset,
+        )
+
+    def parse_query(
+        self, query: Iterable[WallpaperListing]
+    ) -> Tuple[Tuple[int, str, str], List[str]]:
+        """Split listing results into metadata and image sources"""
         table_results = []
         image_srcs = []
         for image in query:
@@ -199,7 +441,7 @@ class Search:
         self.query_data["ids"] = value
 
     @property
-    def colors(self) -> Optional[List[int]]:
+    def colors(self) -> Optional[Dict[int, float]]:
         return self.query_data.get("colors")
 
     @colors.setter
@@ -231,10 +473,23 @@ class Search:
         self.source_types = None
         self.aspect_ratio = None
 
-    def find(self) -> Tuple[Tuple[int, str, str], List[str]]:
-        """Return search results"""
-        query = WallpaperQuery(self.query_data)
-        table, srcs = self.parse_query(query(limit=self.limit))
+    def find(self, offset: int = 0) -> Tuple[Tuple[int, str, str], List[str]]:
+        """Return search results, reusing them if the library has not changed"""
+        generation = library_generation()
+        if generation != self.generation:
+            self._results.clear()
+            self.generation = generation
+
+        key = self.cache_key(offset)
+        if key in self._results:
+            self._results.move_to_end(key)
+            logger.info("Search results served from cache")
+        else:
+            query = WallpaperQuery(self.query_data)
+            self._results[key] = query(limit=self.limit, offset=offset)
+            if len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+        table, srcs = self.parse_query(self._results[key])
         # Hack to fix where the color values are cleared after search
         # since its value isn't accumulated on each search call
         _colors = self.colors
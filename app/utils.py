@@ -10,7 +10,7 @@ from collections import UserList
 from queue import SimpleQueue
 from random import choices
 from string import ascii_lowercase, ascii_uppercase, digits
-from typing import List, Optional, Set, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 
 import aiofiles
 import aiohttp
@@ -19,7 +19,7 @@ from PIL import Image
 
 from app.async_utils import download as async_download
 from app.config import is_windows, user_agent
-from app.db import Wallpaper, create_session
+from app.db import wallpaper_listings
 
 logger = logging.getLogger(__name__)
 
@@ -49,10 +49,7 @@ def download_files(ids: List[int]) -> Tuple[int, Set[Tuple[str, str]]]:
     dst = []
     urls = []
 
-    with create_session() as session:
-        query = session.query(Wallpaper).filter(Wallpaper.id.in_(ids)).all()
-
-    for image in query:
+    for image in wallpaper_listings(ids):
         if image.source_type == "local":
             shutil.copyfile(image.src_path, image.download_path)
         else:
@@ -74,47 +71,93 @@ class ImageList(UserList):
     """
     Acts as list for images to show and a buffer for loading images
     in the background. Provides the standard list capabilities but
-    should be set with `load_images`. This opens a background thread
-    and loads images asynchronously. Make sure to call `clear` before
-    each `load_images` call and `from_queue` in the main event loop.
+    should be set with `load_images`. Images are only loaded when asked
+    for, call `focus` with the selected row to load it first and then
+    `prefetch` rows to either side of it. Loads run on a background thread
+    and each one sends an `-IMAGE_LOADED-` event with its row index.
+    Make sure to call `clear` before each `load_images` call and
+    `from_queue` in the main event loop.
     """
 
     # The `window` arg is actually not optional as it is needed for
     # thread dispatching. It is listed as a keyword arg with None
     # because `UserList` subclasses need constructors with 0 or 1
     # positional List args
-    def __init__(self, seq: List, window: Optional[sg.Window] = None):
+    def __init__(
+        self,
+        seq: List,
+        window: Optional[sg.Window] = None,
+        prefetch: int = 3,
+        workers: int = 4,
+    ):
         super().__init__(seq)
         self.window = window
+        self.prefetch = prefetch
+        self.workers = workers
+        self.run_id = None
+        self.sources: List[str] = []
+        # Rows waiting to load by their distance from the selection,
+        # and rows already loading or loaded for the current run
+        self._wanted: Dict[int, int] = {}
+        self._started: Set[int] = set()
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._ready = threading.Event()
 
     def clear(self):
         """Clear the array and queue and cancel any current image loading"""
-        self.run_id = None
+        with self._lock:
+            self.run_id = None
+            self.sources = []
+            self._wanted = {}
+            self._started = set()
         self.data = []
         while not image_queue.empty():
             image_queue.get()
 
-    # TODO: I may want to introduce chunking functionality
     def load_images(self, image_srcs: List[str]):
         """
-        Start a background thread and load the provided image paths or urls.
+        Set the image paths or urls to show, then load the first rows in the background.
         """
         # Since image will load in async, we need to maintain order
         # by guaranteeing each index position is available
         self.data = [None] * len(image_srcs)
-        # Track each run with a specific value so they can be stopped
-        self.run_id = random_uuid4()
-        thread = self.window.start_thread(
-            lambda: self._load(image_srcs),
-            "-LOAD_THREAD-",
-        )
-        logger.info(f"Thread {thread.ident} started for image loading")
+        with self._lock:
+            self.sources = list(image_srcs)
+            # Track each run with a specific value so they can be stopped
+            self.run_id = random_uuid4()
+            self._wanted = {}
+            self._started = set()
+        if self._loop is None:
+            thread = threading.Thread(target=self._load, daemon=True)
+            thread.start()
+            self._ready.wait()
+            logger.info(f"Thread {thread.ident} started for image loading")
+        self.focus(0)
+
+    def focus(self, index: int):
+        """
+        Load the image at a row ahead of anything else, then the rows around it.
+        Rows queued for an earlier selection that are out of range are dropped.
+        """
+        with self._lock:
+            start = max(index - self.prefetch, 0)
+            end = min(index + self.prefetch + 1, len(self.sources))
+            self._wanted = {
+                ix: abs(ix - index)
+                for ix in range(start, end)
+                if ix not in self._started
+            }
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
 
     def from_queue(self):
         """Load the image array with images from the queue"""
         while not image_queue.empty():
-            ix, image = image_queue.get()
-            self.data[ix] = image
+            run_id, ix, image = image_queue.get()
+            if run_id == self.run_id:
+                self.data[ix] = image
 
     @staticmethod
     def process_image(image: Image, max_width: int = 500):
@@ -124,53 +167,83 @@ class ImageList(UserList):
         image = image.resize((max_width, int(max_width / ar))).convert("RGB")
         return image
 
-    async def _load_source(self, index: int, source: str, run_id: str, retry: int = 0):
+    async def _load_source(
+        self, index: int, source: str, run_id: str, retries: int = 3
+    ):
         """Load an image source into the queue"""
-        try:
-            if source.startswith("http"):
-                timeout = aiohttp.ClientTimeout(total=30)
-                async with aiohttp.ClientSession(
-                    connector=aiohttp.TCPConnector(ssl=False),
-                    timeout=timeout,
-                    headers={"User-Agent": user_agent},
-                ) as session:
-                    response = await session.get(source)
-                    assert response.status == 200
-                    data = await response.read()
-                    image = Image.open(io.BytesIO(data))
-            else:
-                async with aiofiles.open(source, mode="rb") as afp:
-                    data = await afp.read()
-                    image = Image.open(io.BytesIO(data))
-            image = self.process_image(image)
-
-        # Image failures should be represented as `None`
-        except aiohttp.ClientError as err:
-            if retry < 3:
-                retry += 1
+        image = None
+        for retry in range(retries + 1):
+            if retry:
                 logger.info(f"Retry load #{retry} for {source}")
-                await self._load_source(index, source, run_id, retry=retry)
-            else:
-                logger.warning(f"Retries exceeded to load image from {source} - {err}")
+            try:
+                if source.startswith("http"):
+                    timeout = aiohttp.ClientTimeout(total=30)
+                    async with aiohttp.ClientSession(
+                        connector=aiohttp.TCPConnector(ssl=False),
+                        timeout=timeout,
+                        headers={"User-Agent": user_agent},
+                    ) as session:
+                        response = await session.get(source)
+                        assert response.status == 200
+                        data = await response.read()
+                        image = Image.open(io.BytesIO(data))
+                else:
+                    async with aiofiles.open(source, mode="rb") as afp:
+                        data = await afp.read()
+                        image = Image.open(io.BytesIO(data))
+                image = self.process_image(image)
+                break
+
+            # Image failures should be represented as `None`
+            except aiohttp.ClientError as err:
+                image = None
+                if retry == retries:
+                    logger.warning(
+                        f"Retries exceeded to load image from {source} - {err}"
+                    )
+            except Exception as err:
                 image = None
-        except Exception as err:
-            logger.warning(f"Unable to load image from {source} - {err}")
-            image = None
+                logger.warning(f"Unable to load image from {source} - {err}")
+                break
 
         # Acts as a sort of cancel flag. If a new image set is called to
         # load while one is still loading, the old results need to be ignored
         if run_id == self.run_id:
-            image_queue.put((index, image))
+            image_queue.put((run_id, index, image))
+            self.window.write_event_value("-IMAGE_LOADED-", index)
         else:
             logger.info(f"Cancel loading for run: {run_id}")
 
-    async def _gather_load_routines(self, sources: List[str]):
-        load_futures = [
-            self._load_source(index, sources, self.run_id)
-            for index, sources in enumerate(sources)
-        ]
-        await asyncio.gather(*load_futures)
-
-    def _load(self, sources: List[str]):
-        asyncio.run(self._gather_load_routines(sources))
-        logger.info(f"Thread {threading.get_ident()} completed for image loading")
+    def _next_source(self) -> Optional[Tuple[int, str, str]]:
+        """Take the waiting row closest to the selection"""
+        with self._lock:
+            if not self._wanted:
+                return None
+            index = min(self._wanted, key=self._wanted.get)
+            del self._wanted[index]
+            self._started.add(index)
+            return index, self.sources[index], self.run_id
+
+    async def _dispatch(self):
+        """Keep up to `workers` images loading, closest to the selection first"""
+        self._wake = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._ready.set()
+        loading = set()
+        while True:
+            self._wake.clear()
+            while len(loading) < self.workers:
+                source = self._next_source()
+                if source is None:
+                    break
+                loading.add(asyncio.ensure_future(self._load_source(*source)))
+            wake = asyncio.ensure_future(self._wake.wait())
+            done, _ = await asyncio.wait(
+                loading | {wake}, return_when=asyncio.FIRST_COMPLETED
+            )
+            loading -= done
+            if wake not in done:
+                wake.cancel()
+
+    def _load(self):
+        asyncio.run(self._dispatch())
@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+from queue import Empty, Queue
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from app.db import UpdateMapping, write_analysis
+from app.duplicates import DuplicateIndex
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisWriter:
+    """
+    Collects image analysis results from any thread and saves them on a
+    dedicated background thread. Results are coalesced into large single
+    transactions, written once `batch_size` results are waiting or after
+    `interval` seconds, whichever comes first. Use as a context manager or
+    call `start` and `close` so pending results are flushed on exit.
+    New image hashes are checked against the duplicate index as they are saved.
+    """
+
+    def __init__(self, batch_size: int = 500, interval: float = 2.0):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.written = 0
+        self._queue = Queue()
+        self._thread: Optional[threading.Thread] = None
+        self.duplicates: Optional[DuplicateIndex] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        self.duplicates = DuplicateIndex()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logger.info(f"Thread {self._thread.ident} started for analysis writes")
+
+    def put(
+        self, mapping: UpdateMapping, colors: List[int], feature: Optional[bytes] = None
+    ):
+        """Queue the analysis results of a single image for saving"""
+        self._queue.put((mapping, colors, feature))
+
+    def close(self):
+        """Write any pending results and stop the writer thread"""
+        self._queue.put(None)
+        self._thread.join()
+        self.duplicates.save()
+
+    def _flush(self, pending: List[tuple]):
+        mappings = []
+        wallpaper_to_colors: Dict[int, List[int]] = {}
+        features: Dict[int, bytes] = {}
+        for mapping, colors, feature in pending:
+            mappings.append(mapping)
+            wallpaper_to_colors[mapping["id"]] = colors
+            if feature is not None:
+                features[mapping["id"]] = feature
+        hashed = [mapping for mapping in mappings if mapping.get("dhash") is not None]
+        ids = np.array([mapping["id"] for mapping in hashed], dtype=np.int64)
+        dhashes = np.array(
+            [int(mapping["dhash"]) for mapping in hashed], dtype=np.uint64
+        )
+        try:
+            pairs = self.duplicates.check(ids, dhashes)
+            write_analysis(mappings, wallpaper_to_colors, pairs, features)
+        # Unsaved images stay unanalyzed and are picked up by a later scan
+        except Exception:
+            logger.exception(f"Failed to save analysis for {len(pending)} images")
+        else:
+            self.duplicates.insert(ids, dhashes)
+            self.written += len(pending)
+            logger.info(f"Saved analysis for {len(pending)} images")
+
+    def _run(self):
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                item = ()
+
+            if item:
+                if not pending:
+                    deadline = time.monotonic() + self.interval
+                pending.append(item)
+
+            done = item is None
+            if pending and (
+                done or len(pending) >= self.batch_size or time.monotonic() >= deadline
+            ):
+                self._flush(pending)
+                pending = []
+                deadline = None
+            if done:
+                break
+        logger.info(f"Thread {threading.get_ident()} completed for analysis writes")
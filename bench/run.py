@@ -0,0 +1,111 @@
+"""
+End to end scan benchmark against the local fake servers.
+Crawls every client source and a dir of local images into a fresh library,
+analyzes everything found, and reports the images per second of each stage.
+
+    python -m bench.run --images 200 --latency 0.05 --rate-limited 0.01
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+
+import imgurpython.client
+
+from app.analyze import Scanner
+from app.clients import MyImgurClient, MyWallhavenClient, RedditClient
+from app.config import ConfigObject, config
+from app.db import create_tables, library_stats
+from bench.servers import FakeServers, synthetic_image
+
+
+def configure(root: str, servers: FakeServers, n_local: int):
+    """Point the app config at a new library and the clients at the fake servers"""
+    image_dir = os.path.join(root, "images")
+    os.makedirs(image_dir)
+    for i in range(n_local):
+        with open(os.path.join(image_dir, f"local{i}.jpg"), "wb") as file:
+            file.write(synthetic_image(f"local{i}", servers.image_size))
+
+    config.config.read_dict(config.default())
+    config.config.read_dict(
+        {
+            "core": {
+                "image_dirs": image_dir,
+                "db_loc": os.path.join(root, "data.db"),
+                "download_loc": os.path.join(root, "downloads"),
+                "cache_loc": os.path.join(root, "cache"),
+            },
+            "reddit": {
+                "enabled": "True",
+                "client_id": "bench",
+                "client_secret": "bench",
+                "username": "bench",
+                "password": "bench",
+            },
+            "imgur": {
+                "enabled": "True",
+                "client_id": "bench",
+                "client_secret": "bench",
+                "access_token": "bench",
+                "refresh_token": "bench",
+            },
+            "wallhaven": {"enabled": "True", "api_key": "bench", "username": "bench"},
+        }
+    )
+    for section in config.config.sections():
+        setattr(config, section, ConfigObject(config.config, section))
+    create_tables()
+
+    RedditClient.reddit_url = servers.url
+    RedditClient.oauth_url = servers.url
+    # imgurpython has no setting for its api address
+    imgurpython.client.API_URL = f"{servers.url}/imgur/"
+    MyImgurClient.api_url = f"{servers.url}/imgur/3"
+    MyWallhavenClient.api_url = f"{servers.url}/wallhaven/api/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--images", type=int, default=100, help="images per source")
+    parser.add_argument("--local", type=int, default=20, help="local image files")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds per request"
+    )
+    parser.add_argument(
+        "--rate-limited", type=float, default=0.0, help="share of requests given a 429"
+    )
+    parser.add_argument(
+        "--failures", type=float, default=0.0, help="share of requests given a 500"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+
+    servers = FakeServers(
+        n_images=args.images,
+        latency=args.latency,
+        rate_limited=args.rate_limited,
+        failures=args.failures,
+        seed=args.seed,
+    )
+    with servers, tempfile.TemporaryDirectory() as root:
+        configure(root, servers, args.local)
+        scanner = Scanner()
+        scanner.scan()
+        stats = library_stats()
+
+    print(f"{'stage':<10}{'images':>8}{'seconds':>10}{'images/s':>10}")
+    for name, stage in scanner.stages.items():
+        print(f"{name:<10}{stage.images:>8}{stage.seconds:>10.2f}{stage.rate:>10.1f}")
+    print()
+    for source_type, counts in sorted(stats.items()):
+        print(f"{source_type:<10}{counts.total:>8} saved{counts.analyzed:>8} analyzed")
+    print(f"{servers.requests} requests served")
+
+
+if __name__ == "__main__":
+    main()
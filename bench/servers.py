@@ -0,0 +1,268 @@
+"""
+Local stand-ins for the Reddit, Imgur and Wallhaven apis and the hosts of their
+images. Every source lists `n_images` synthetic wallpapers, and responses can be
+slowed down, rate limited or failed at random to exercise the clients.
+"""
+
+import asyncio
+import io
+import random
+import threading
+import time
+import zlib
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import numpy as np
+from aiohttp import web
+from PIL import Image
+
+# Requests needed to start a client session are never faulted.
+# praw drops any path from its api addresses so reddit is served from the root
+SETUP_PATHS = (
+    "/api/v1/access_token",
+    "/api/v1/me",
+    "/imgur/3/credits",
+    "/wallhaven/api/v1/collections",
+)
+
+
+@lru_cache(maxsize=64)
+def synthetic_image(name: str, size: Tuple[int, int]) -> bytes:
+    """A jpeg wallpaper of colored gradients and blocks, always the same for a name"""
+    rng = np.random.default_rng(zlib.crc32(name.encode()))
+    width, height = size
+    x = np.linspace(0, 1, width)[None, :, None]
+    y = np.linspace(0, 1, height)[:, None, None]
+    start, end, across = rng.integers(0, 256, (3, 3))
+    pixels = start + (end - start) * x + (across - start) * y * x
+    for _ in range(rng.integers(3, 8)):
+        left, top = rng.integers(0, width), rng.integers(0, height)
+        right, bottom = left + rng.integers(20, width // 2), top + rng.integers(
+            20, height // 2
+        )
+        pixels[top:bottom, left:right] = rng.integers(0, 256, 3)
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+class FakeServers:
+    """
+    A single local http server for all the fake apis, run on a background thread.
+    Use as a context manager, `url` is the base address once started.
+    - latency: seconds added to every faultable request
+    - rate_limited: share of faultable requests answered with a 429
+    - failures: share of faultable requests answered with a 500
+    """
+
+    def __init__(
+        self,
+        n_images: int = 100,
+        latency: float = 0.0,
+        rate_limited: float = 0.0,
+        failures: float = 0.0,
+        image_size: Tuple[int, int] = (1280, 720),
+        seed: int = 0,
+    ):
+        self.n_images = n_images
+        self.latency = latency
+        self.rate_limited = rate_limited
+        self.failures = failures
+        self.image_size = image_size
+        self.random = random.Random(seed)
+        self.url: Optional[str] = None
+        self.requests = 0
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._runner = web.AppRunner(self.app())
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        self._loop.run_until_complete(site.start())
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+        self._started.set()
+        self._loop.run_forever()
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.faults])
+        app.add_routes(
+            [
+                web.post("/api/v1/access_token", self.reddit_token),
+                web.get("/api/v1/me", self.reddit_me),
+                web.get("/user/{user}/saved", self.reddit_saved),
+                web.get("/imgur/3/credits", self.imgur_credits),
+                web.get(
+                    "/imgur/3/account/{user}/favorites/{page}", self.imgur_favorites
+                ),
+                web.get("/imgur/3/gallery/album/{album}", self.imgur_album),
+                web.get("/wallhaven/api/v1/collections", self.wallhaven_collections),
+                web.get(
+                    "/wallhaven/api/v1/collections/{user}/{id}",
+                    self.wallhaven_collection,
+                ),
+                web.get("/images/{name}", self.image),
+            ]
+        )
+        return app
+
+    @web.middleware
+    async def faults(self, request: web.Request, handler):
+        self.requests += 1
+        if request.path in SETUP_PATHS:
+            return await handler(request)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chance = self.random.random()
+        if chance < self.rate_limited:
+            headers = {
+                "Retry-After": "1",
+                "X-RateLimit-UserRemaining": "0",
+                "X-RateLimit-UserReset": str(time.time() + 1),
+            }
+            return web.json_response(
+                {"error": "rate limited"}, status=429, headers=headers
+            )
+        if chance < self.rate_limited + self.failures:
+            return web.json_response({"error": "server error"}, status=500)
+        return await handler(request)
+
+    def image_url(self, name: str, extension: bool = True) -> str:
+        return f"{self.url}/images/{name}{'.jpg' if extension else ''}"
+
+    async def image(self, request: web.Request) -> web.Response:
+        name = request.match_info["name"].rsplit(".", 1)[0]
+        if request.method == "HEAD":
+            return web.Response(content_type="image/jpeg")
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(None, synthetic_image, name, self.image_size)
+        return web.Response(body=body, content_type="image/jpeg")
+
+    # Reddit, https://www.reddit.com/dev/api
+    async def reddit_token(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "access_token": "token",
+                "token_type": "bearer",
+                "expires_in": 3600,
+                "scope": "*",
+            }
+        )
+
+    async def reddit_me(self, request: web.Request) -> web.Response:
+        return web.json_response({"name": "bench", "id": "bench"})
+
+    async def reddit_saved(self, request: web.Request) -> web.Response:
+        limit = int(request.query.get("limit", 25))
+        after = request.query.get("after")
+        start = int(after.split("_r")[-1]) + 1 if after else 0
+        children = []
+        for i in range(start, min(start + limit, self.n_images)):
+            # Every fourth link has no extension and needs its type probed
+            url = self.image_url(f"r{i}", extension=i % 4 != 0)
+            children.append(
+                {
+                    "kind": "t3",
+                    "data": {
+                        "id": f"r{i}",
+                        "name": f"t3_r{i}",
+                        "subreddit": "wallpaper",
+                        "url": url,
+                        "title": f"Wallpaper {i}",
+                        "removal_reason": None,
+                        "is_gallery": False,
+                    },
+                }
+            )
+        last = start + len(children)
+        return web.json_response(
+            {
+                "kind": "Listing",
+                "data": {
+                    "after": f"t3_r{last - 1}" if last < self.n_images else None,
+                    "before": None,
+                    "children": children,
+                },
+            }
+        )
+
+    # Imgur, https://apidocs.imgur.com
+    album_size = 5
+    favorites_page = 60
+
+    def imgur_headers(self) -> dict:
+        return {
+            "X-RateLimit-UserRemaining": "12500",
+            "X-RateLimit-UserReset": str(int(time.time()) + 3600),
+            "X-RateLimit-ClientRemaining": "12500",
+        }
+
+    async def imgur_credits(self, request: web.Request) -> web.Response:
+        return web.json_response({"data": {"UserRemaining": 12500}, "success": True})
+
+    async def imgur_favorites(self, request: web.Request) -> web.Response:
+        page = int(request.match_info["page"])
+        n_albums = -(-self.n_images // self.album_size)
+        start = page * self.favorites_page
+        albums = [
+            {"id": f"a{album}", "is_album": True, "title": f"Album {album}"}
+            for album in range(start, min(start + self.favorites_page, n_albums))
+        ]
+        return web.json_response(
+            {"data": albums, "success": True}, headers=self.imgur_headers()
+        )
+
+    async def imgur_album(self, request: web.Request) -> web.Response:
+        album = int(request.match_info["album"][1:])
+        start = album * self.album_size
+        images = [
+            {"id": f"i{i}", "link": self.image_url(f"i{i}"), "type": "image/jpeg"}
+            for i in range(start, min(start + self.album_size, self.n_images))
+        ]
+        return web.json_response(
+            {"data": {"id": f"a{album}", "images": images}, "success": True},
+            headers=self.imgur_headers(),
+        )
+
+    # Wallhaven, https://wallhaven.cc/help/api
+    collection_page = 24
+
+    async def wallhaven_collections(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {"data": [{"id": 1, "label": "Default", "count": self.n_images}]}
+        )
+
+    async def wallhaven_collection(self, request: web.Request) -> web.Response:
+        page = int(request.query.get("page", 1))
+        start = (page - 1) * self.collection_page
+        wallpapers = [
+            {"id": f"w{i}", "path": self.image_url(f"w{i}"), "file_type": "image/jpeg"}
+            for i in range(start, min(start + self.collection_page, self.n_images))
+        ]
+        last_page = max(-(-self.n_images // self.collection_page), 1)
+        return web.json_response(
+            {"data": wallpapers, "meta": {"current_page": page, "last_page": last_page}}
+        )
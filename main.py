@@ -24,7 +24,8 @@ if __name__ == "__main__":
 
     if not os.path.exists(config.core.db_loc):
         logging.warning(f"Database not found, creating one at {config.core.db_loc}")
-        create_tables()
+    # Existing databases may be missing tables added in newer versions
+    create_tables()
     
     if debug_mode():
         logging.info('Application started in debug mode!')
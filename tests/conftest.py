@@ -0,0 +1,20 @@
+import os
+
+import pytest
+
+from app.config import ConfigObject, config
+from app.db import create_tables
+
+
+@pytest.fixture
+def library(tmp_path):
+    """Point the app config at a fresh database file"""
+    config.config.read_dict(config.default())
+    config.config.set("core", "db_loc", os.path.join(tmp_path, "data.db"))
+    config.config.set("core", "download_loc", str(tmp_path))
+    config.config.set("core", "cache_loc", os.path.join(tmp_path, "cache"))
+    for section in config.config.sections():
+        setattr(config, section, ConfigObject(config.config, section))
+    create_tables()
+    yield
+
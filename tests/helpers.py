@@ -0,0 +1,16 @@
+from app.db import bulk_insert_wallpapers
+
+
+def add_wallpapers(count, source_type="local", analyzed=True):
+    bulk_insert_wallpapers(
+        [
+            {
+                "source_type": source_type,
+                "source_id": f"{source_type}{i}",
+                "source_uri": "/images",
+                "image_type": "jpg",
+                "analyzed": analyzed,
+            }
+            for i in range(count)
+        ]
+    )
@@ -0,0 +1,242 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from app.clients.imgur import MyImgurClient
+from app.clients.reddit import RedditClient
+from app.clients.wallhaven import MyWallhavenClient
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200, headers=None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code != 200:
+            raise requests.HTTPError(self.status_code)
+
+
+class FakeSession:
+    def fresh(self, url, params=None):
+        return False
+
+
+class FakeAlbums(FakeSession):
+    """Album detail endpoint that answers later albums sooner"""
+
+    def __init__(self, n_albums):
+        self.n_albums = n_albums
+        self.active = 0
+        self.most_active = 0
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        album = int(url.split("/")[-1])
+        with self.lock:
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        time.sleep(0.02 * (self.n_albums - album))
+        with self.lock:
+            self.active -= 1
+        images = [{"id": f"{album}-{i}"} for i in range(2)]
+        return FakeResponse({"data": {"images": images}})
+
+
+def imgur_client(favorites, session):
+    client = MyImgurClient.__new__(MyImgurClient)
+    pages = [[SimpleNamespace(id=str(item)) for item in favorites], []]
+    client.client = SimpleNamespace(
+        get_account_favorites=lambda user, page: pages[page]
+    )
+    client.full_sync = True
+    client.requests_per_minute = 60000
+    client.saved_ids = frozenset(["2-0"])
+    client.session = session
+    return client
+
+
+def test_imgur_albums_fetched_concurrently_in_order():
+    albums = FakeAlbums(8)
+    client = imgur_client(range(8), albums)
+    start = time.monotonic()
+    images = [image["id"] for image in client.images()]
+    expected = [f"{album}-{i}" for album in range(8) for i in range(2)]
+    expected.remove("2-0")
+    assert images == expected
+    assert albums.most_active == client.album_workers
+    assert time.monotonic() - start < 0.02 * sum(range(9)) / 2
+    assert client.next_cursor == "0"
+
+
+def test_imgur_pauses_on_rate_limit():
+    client = imgur_client([], None)
+    reset = time.time() + 30
+    headers = {"X-RateLimit-UserRemaining": "1", "X-RateLimit-UserReset": str(reset)}
+    client.check_rate_limit(FakeResponse({}, headers=headers))
+    assert client.paused_until == reset
+    assert not client.canceled.is_set()
+
+    client.check_rate_limit(
+        FakeResponse({}, headers={"X-RateLimit-ClientRemaining": "0"})
+    )
+    assert client.canceled.is_set()
+    assert client.album_images(SimpleNamespace(id="1")) == []
+
+
+class FakePages(FakeSession):
+    """Paged listing endpoint, rate limiting the first request for page 2"""
+
+    def __init__(self, n_pages):
+        self.n_pages = n_pages
+        self.requested = []
+        self.limited = False
+
+    def get(self, url, params):
+        page = params["page"]
+        self.requested.append(page)
+        if page == 2 and not self.limited:
+            self.limited = True
+            return FakeResponse({}, status_code=429, headers={"Retry-After": "0.05"})
+        data = [{"id": f"{page}-{i}"} for i in range(3)]
+        return FakeResponse({"data": data, "meta": {"last_page": self.n_pages}})
+
+
+def wallhaven_client(session):
+    client = MyWallhavenClient.__new__(MyWallhavenClient)
+    client.api_key = "key"
+    client.requests_per_minute = 60000
+    client.session = session
+    return client
+
+
+def test_wallhaven_pages_stream_in_order():
+    listing = FakePages(5)
+    client = wallhaven_client(listing)
+    items = [obj["id"] for obj in client.make_request("https://wallhaven.cc/api")]
+    assert items == [f"{page}-{i}" for page in range(1, 6) for i in range(3)]
+    # Page 2 was retried after its Retry-After time
+    assert sorted(listing.requested) == [1, 2, 2, 3, 4, 5]
+
+
+def test_wallhaven_pages_stop_early():
+    listing = FakePages(50)
+    client = wallhaven_client(listing)
+    pages = client.pages("https://wallhaven.cc/api")
+    assert next(pages)[0]["id"] == "1-0"
+    assert next(pages)[0]["id"] == "2-0"
+    pages.close()
+    assert max(listing.requested) <= 2 + client.prefetch
+
+
+class Throttled(FakePages):
+    """Listing that rate limits every page after the `free` ones"""
+
+    def __init__(self, n_pages, retry_after, free=1):
+        super().__init__(n_pages)
+        self.retry_after = retry_after
+        self.free = free
+
+    def get(self, url, params):
+        if params["page"] <= self.free:
+            return super().get(url, params)
+        self.requested.append(params["page"])
+        headers = {"Retry-After": self.retry_after}
+        return FakeResponse({}, status_code=429, headers=headers)
+
+
+def test_wallhaven_retries_then_fails():
+    listing = Throttled(2, "0")
+    client = wallhaven_client(listing)
+    with pytest.raises(requests.HTTPError):
+        client.get_page("https://wallhaven.cc/api", {}, 2)
+    assert listing.requested == [2] * (client.max_retries + 1)
+
+    # No wait follows the last attempt
+    client.session = Throttled(2, "30")
+    client.max_retries = 0
+    start = time.monotonic()
+    with pytest.raises(requests.HTTPError):
+        client.get_page("https://wallhaven.cc/api", {}, 2)
+    assert time.monotonic() - start < 1
+
+
+def test_wallhaven_close_does_not_wait_on_retries():
+    listing = Throttled(10, "30", free=2)
+    client = wallhaven_client(listing)
+    pages = client.pages("https://wallhaven.cc/api")
+    next(pages)
+    next(pages)
+    # Page 3 is waiting out its Retry-After in the background
+    start = time.monotonic()
+    pages.close()
+    assert time.monotonic() - start < 1
+    time.sleep(0.5)
+    assert listing.requested.count(3) == 1
+
+
+class FakeLinks(FakeSession):
+    """Image host answering HEAD requests with the type in the link"""
+
+    def __init__(self, busy=False):
+        self.probed = []
+        self.busy = busy
+
+    def head(self, url, timeout):
+        self.probed.append(url)
+        if "missing" in url:
+            return FakeResponse({}, status_code=404)
+        if self.busy:
+            return FakeResponse({}, status_code=503)
+        return FakeResponse({}, headers={"Content-Type": url.split("=")[-1]})
+
+
+def reddit_client(session, urls):
+    client = RedditClient.__new__(RedditClient)
+    client.session = session
+    client.submissions = lambda: (
+        SimpleNamespace(id=str(i), url=url) for i, url in enumerate(urls)
+    )
+    return client
+
+
+def test_reddit_links_probed_once(library):
+    links = FakeLinks()
+    urls = [
+        "https://i.redd.it/a.png",
+        "https://host/b?type=image/jpeg",
+        "https://host/c?type=text/html",
+        "https://host/missing",
+    ]
+    entries = list(reddit_client(links, urls).fetch(10))
+    assert [(entry["source_id"], entry["image_type"]) for entry in entries] == [
+        ("0", "png"),
+        ("1", "jpeg"),
+    ]
+    assert sorted(links.probed) == sorted(urls[1:])
+
+    # Probe results, links that are gone included, are cached for later crawls
+    links.probed = []
+    assert len(list(reddit_client(links, urls).fetch(10))) == 2
+    assert links.probed == []
+
+
+def test_reddit_failed_probes_retried(library):
+    urls = ["https://i.redd.it/a.png", "https://host/b?type=image/jpeg"]
+    client = reddit_client(FakeLinks(busy=True), urls)
+    client.cursor = "t3_old"
+    assert [entry["source_id"] for entry in client.fetch(10)] == ["0"]
+    # The skipped post is listed again next crawl
+    assert client.completed_cursor == "t3_old"
+
+    links = FakeLinks()
+    entries = list(reddit_client(links, urls).fetch(10))
+    assert links.probed == urls[1:]
+    assert [entry["image_type"] for entry in entries] == ["png", "jpeg"]
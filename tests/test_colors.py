@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from colormath.color_conversions import convert_color
+from colormath.color_objects import LabColor, sRGBColor
+
+from app.colors import hex_to_lab
+
+# Max absolute difference allowed against colormath for Lab components
+LAB_TOLERANCE = 1e-6
+
+
+@pytest.fixture
+def hex_values():
+    rng = np.random.default_rng(7)
+    extremes = [0x000000, 0xFFFFFF, 0xFF0000, 0x00FF00, 0x0000FF, 0x010101, 0x0A0B0C]
+    return np.concatenate((extremes, rng.integers(0, 0xFFFFFF, 2000)))
+
+
+def colormath_lab(value):
+    color = sRGBColor(
+        (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF, is_upscaled=True
+    )
+    return convert_color(color, LabColor).get_value_tuple()
+
+
+def test_hex_to_lab_matches_colormath(hex_values):
+    expected = np.array([colormath_lab(int(value)) for value in hex_values])
+    assert np.abs(hex_to_lab(hex_values) - expected).max() < LAB_TOLERANCE
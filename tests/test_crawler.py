@@ -0,0 +1,192 @@
+import threading
+import time
+
+import imgurpython.client
+import pytest
+
+from app.analyze import Crawler
+from app.clients import MyImgurClient, MyWallhavenClient, RedditClient
+from app.clients.base import Client, RateLimiter
+from app.config import config
+from app.db import library_stats, save_sync_cursor, sync_cursor
+from bench.servers import FakeServers
+
+
+class SlowClient(Client):
+    source_type = "reddit"
+    requests_per_minute = 600
+
+    def images(self):
+        for i in range(3):
+            if not self.throttle():
+                return
+            yield i
+
+    def to_db(self, obj):
+        return {
+            "source_uri": f"https://example.com/{self.source_type}{obj}.jpg",
+            "source_id": f"{self.source_type}{obj}",
+            "source_type": self.source_type,
+            "image_type": "jpg",
+            "analyzed": False,
+        }
+
+
+class OtherClient(SlowClient):
+    source_type = "wallhaven"
+
+
+class BrokenClient(SlowClient):
+    source_type = "imgur"
+
+    def images(self):
+        yield from super().images()
+        raise RuntimeError("api is down")
+
+
+def test_rate_limiter_spaces_calls():
+    limiter = RateLimiter(20, burst=2)
+    start = time.monotonic()
+    for _ in range(4):
+        assert limiter.wait()
+    # Two calls fit the burst, the other two wait a twentieth of a second each
+    assert time.monotonic() - start >= 0.09
+
+
+def test_rate_limiter_wait_stops_on_cancel():
+    limiter = RateLimiter(1, per=60)
+    cancel = threading.Event()
+    assert limiter.wait(cancel)
+    cancel.set()
+    assert not limiter.wait(cancel)
+
+
+def test_crawler_runs_sources_concurrently(library, tmp_path, monkeypatch):
+    monkeypatch.setattr(Crawler, "client_enabled", staticmethod(lambda client: True))
+    (tmp_path / "images").mkdir()
+    (tmp_path / "images" / "local.jpg").touch()
+    config.core.image_dirs = [str(tmp_path / "images")]
+    events = []
+    crawler = Crawler(batch_size=2, progress=events.append)
+    crawler.clients = (SlowClient, OtherClient, BrokenClient)
+    start = time.monotonic()
+    # A failing source is logged and what it fetched is still saved
+    assert crawler(10) == 10
+    # Each source waits 0.2 seconds on its own rate limit
+    assert time.monotonic() - start < 0.35
+    stats = library_stats()
+    assert stats["reddit"].total == 3
+    assert stats["wallhaven"].total == 3
+    assert stats["imgur"].total == 3
+    assert stats["local"].total == 1
+    # Progress is reported for every saved chunk
+    assert len(events) >= 5
+    assert [event.total for event in events] == sorted(event.total for event in events)
+    assert events[-1].saved == {"reddit": 3, "wallhaven": 3, "imgur": 3, "local": 1}
+
+
+def test_crawler_cancel_stops_running_clients(library, tmp_path, monkeypatch):
+    (tmp_path / "images").mkdir()
+    config.core.image_dirs = [str(tmp_path / "images")]
+    monkeypatch.setattr(Crawler, "client_enabled", staticmethod(lambda client: True))
+
+    class Stalled(SlowClient):
+        requests_per_minute = 1
+
+    crawler = Crawler()
+    crawler.clients = (Stalled,)
+    threading.Timer(0.2, crawler.cancel).start()
+    start = time.monotonic()
+    # Entries fetched before the cancel are kept
+    assert crawler(10) == 1
+    assert time.monotonic() - start < 1
+    assert library_stats()["reddit"].total == 1
+
+
+class ListingClient(SlowClient):
+    """Source listing the newest items first"""
+
+    listing = ["c", "b", "a"]
+
+    def images(self):
+        for item in self.listing:
+            if self.next_cursor is None:
+                self.next_cursor = item
+            if item == self.cursor:
+                return
+            yield item
+
+
+def test_clients_stop_at_sync_cursor(library, monkeypatch):
+    client = ListingClient()
+    assert [entry["source_id"] for entry in client.fetch(10)] == [
+        "redditc",
+        "redditb",
+        "reddita",
+    ]
+    # The caller saves the cursor once the entries are committed
+    assert client.completed_cursor == "c"
+    assert sync_cursor("reddit") is None
+    save_sync_cursor("reddit", "c")
+
+    monkeypatch.setattr(ListingClient, "listing", ["e", "d", "c", "b", "a"])
+    # A crawl cut short by its limit has no cursor to save
+    client = ListingClient()
+    assert len(list(client.fetch(0))) == 1
+    assert client.completed_cursor is None
+    client = ListingClient()
+    assert [entry["source_id"] for entry in client.fetch(10)] == [
+        "reddite",
+        "redditd",
+    ]
+    assert client.completed_cursor == "e"
+
+    client = ListingClient()
+    client.full_sync = True
+    assert len(list(client.fetch(10))) == 5
+
+
+def test_crawler_saves_cursor_after_commit(library, tmp_path, monkeypatch):
+    (tmp_path / "images").mkdir()
+    config.core.image_dirs = [str(tmp_path / "images")]
+    monkeypatch.setattr(Crawler, "client_enabled", staticmethod(lambda client: True))
+    crawler = Crawler()
+    crawler.clients = (ListingClient,)
+
+    def failed_insert(mappings):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as patch:
+        patch.setattr("app.analyze.bulk_insert_wallpapers", failed_insert)
+        with pytest.raises(OSError):
+            crawler(10)
+    # Nothing was committed so the next crawl fetches it all again
+    assert sync_cursor("reddit") is None
+    crawler = Crawler()
+    crawler.clients = (ListingClient,)
+    assert crawler(10) == 3
+    assert sync_cursor("reddit") == "c"
+
+
+def test_crawl_fake_sources(library, tmp_path, monkeypatch):
+    (tmp_path / "images").mkdir()
+    config.core.image_dirs = [str(tmp_path / "images")]
+    with FakeServers(n_images=12) as servers:
+        # Any value works as credentials for the stand-ins
+        for section in ("reddit", "imgur", "wallhaven"):
+            for option in config.config.options(section):
+                config.config.set(section, option, "True")
+        monkeypatch.setattr(RedditClient, "reddit_url", servers.url)
+        monkeypatch.setattr(RedditClient, "oauth_url", servers.url)
+        monkeypatch.setattr(imgurpython.client, "API_URL", f"{servers.url}/imgur/")
+        monkeypatch.setattr(MyImgurClient, "api_url", f"{servers.url}/imgur/3")
+        monkeypatch.setattr(
+            MyWallhavenClient, "api_url", f"{servers.url}/wallhaven/api/v1"
+        )
+        assert Crawler()(100) == 36
+    stats = library_stats()
+    assert [stats[source].total for source in ("reddit", "imgur", "wallhaven")] == [
+        12,
+        12,
+        12,
+    ]
@@ -0,0 +1,84 @@
+import io
+import os
+
+import requests
+from requests.adapters import BaseAdapter
+from urllib3 import HTTPResponse
+
+from app.http_cache import CachedSession
+
+
+class FakeApi(BaseAdapter):
+    """Answers every url with its body, honoring ETag revalidation"""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+        self.body = b"listing"
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        etag = f'"{len(self.body)}"'
+        status = 304 if request.headers.get("If-None-Match") == etag else 200
+        raw = HTTPResponse(
+            body=io.BytesIO(b"" if status == 304 else self.body),
+            headers={"ETag": etag, "X-RateLimit-UserRemaining": "9"},
+            status=status,
+            preload_content=False,
+        )
+        return requests.adapters.HTTPAdapter().build_response(request, raw)
+
+    def close(self):
+        pass
+
+
+def cached_session(tmp_path, **kwargs):
+    session = CachedSession(cache_dir=str(tmp_path), **kwargs)
+    api = FakeApi()
+    session.mount("http://api/", api)
+    return session, api
+
+
+def test_fresh_responses_skip_the_network(tmp_path):
+    session, api = cached_session(tmp_path, ttls={"/albums/": 60})
+    assert not session.fresh("http://api/albums/1")
+    assert session.get("http://api/albums/1").content == b"listing"
+    assert session.fresh("http://api/albums/1")
+    response = session.get("http://api/albums/1")
+    assert response.content == b"listing"
+    assert response.from_cache
+    assert len(api.sent) == 1
+    # Only a few headers are kept with the body
+    assert "X-RateLimit-UserRemaining" not in response.headers
+
+
+def test_stale_responses_revalidated(tmp_path):
+    session, api = cached_session(tmp_path)
+    session.get("http://api/favorites", params={"page": 1})
+    response = session.get("http://api/favorites", params={"page": 1})
+    assert response.status_code == 200
+    assert response.content == b"listing"
+    assert response.headers["X-RateLimit-UserRemaining"] == "9"
+    assert api.sent[-1].headers["If-None-Match"] == '"7"'
+
+    api.body = b"new listing"
+    assert session.get("http://api/favorites", params={"page": 1}).content == (
+        b"new listing"
+    )
+    # Other pages are cached on their own
+    assert "If-None-Match" not in session.get("http://api/favorites").request.headers
+
+
+def test_cache_size_bounded(tmp_path):
+    session, api = cached_session(tmp_path, ttls={"/": 60}, max_size=1000)
+    api.body = b"x" * 300
+    for i in range(5):
+        session.get(f"http://api/{i}")
+    session.get("http://api/0")
+    session.get("http://api/5")
+    size = sum(entry.stat().st_size for entry in os.scandir(tmp_path))
+    assert size <= 1000
+    # The least recently used responses went first
+    assert session.fresh("http://api/0")
+    assert session.fresh("http://api/5")
+    assert not session.fresh("http://api/1")
@@ -0,0 +1,157 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from app.index import HammingIndex, NearestIndex, popcount
+
+
+@pytest.fixture
+def lab_points():
+    rng = np.random.default_rng(3)
+    return rng.uniform((0, -100, -100), (100, 100, 100), (5000, 3)).astype(np.float32)
+
+
+def naive_nearest(points, query, k):
+    distances = np.sqrt(((points - query) ** 2).sum(axis=1))
+    return np.sort(distances)[:k]
+
+
+@pytest.mark.parametrize("grid_threshold", [10**9, 100])
+def test_nearest_matches_naive(lab_points, grid_threshold, monkeypatch):
+    monkeypatch.setattr(NearestIndex, "grid_threshold", grid_threshold)
+    index = NearestIndex(lab_points)
+    queries = np.array([[50, 0, 0], [0, -100, 100], [100, 120, -130], [3, 4, 5]])
+    distances, indexes = index.query(queries, k=15)
+    assert distances.shape == indexes.shape == (4, 15)
+    for query, dist, idx in zip(queries, distances, indexes):
+        expected = naive_nearest(lab_points, query, 15)
+        assert np.allclose(dist, expected, atol=1e-3)
+        assert np.allclose(
+            np.sqrt(((lab_points[idx] - query) ** 2).sum(axis=1)), dist, atol=1e-3
+        )
+
+
+def test_nearest_k_larger_than_index():
+    index = NearestIndex([[0, 0, 0], [1, 1, 1]])
+    distances, indexes = index.query([0, 0, 0], k=5)
+    assert indexes.tolist() == [[0, 1]]
+    assert distances[0, 0] == 0
+
+
+@pytest.mark.parametrize("grid_threshold", [10**9, 100])
+def test_insert_and_remove(lab_points, grid_threshold, monkeypatch):
+    monkeypatch.setattr(NearestIndex, "grid_threshold", grid_threshold)
+    ids = np.arange(len(lab_points)) + 1000
+    index = NearestIndex(lab_points[:4000], ids[:4000])
+    index.insert(lab_points[4000:4200], ids[4000:4200])
+    index.remove(ids[:10])
+    assert len(index) == 4190
+
+    queries = lab_points[[0, 4100, 4500]]
+    distances, found = index.query(queries, k=5)
+    assert not np.isin(found, ids[:10]).any()
+    assert found[1, 0] == ids[4100] and distances[1, 0] == 0
+    assert distances[2, 0] > 0
+
+    index.insert(lab_points[4200:], ids[4200:])
+    assert len(index) == 4990
+    assert index.query(queries, k=1)[1][2, 0] == ids[4500]
+
+
+def test_snapshot_round_trip(lab_points, tmp_path, monkeypatch):
+    monkeypatch.setattr(NearestIndex, "grid_threshold", 100)
+    path = str(tmp_path / "index")
+    index = NearestIndex(lab_points)
+    index.remove([1, 2, 3])
+    index.save(path, generation=7)
+
+    loaded, meta = NearestIndex.load(path)
+    assert meta["generation"] == 7
+    assert len(loaded) == len(lab_points) - 3
+    queries = lab_points[:20]
+    expected = index.query(queries, k=4)
+    result = loaded.query(queries, k=4)
+    assert np.allclose(expected[0], result[0])
+    assert (expected[1] == result[1]).all()
+
+
+def test_missing_snapshot(tmp_path):
+    assert NearestIndex.load(str(tmp_path / "missing")) == (None, {})
+
+
+@pytest.mark.parametrize("radius", [0, 1, 3])
+def test_hamming_pairs_match_naive(radius):
+    rng = np.random.default_rng(5)
+    hashes = rng.integers(0, 2**64 - 1, 1000, dtype=np.uint64, endpoint=True)
+    # Near copies differing by one or two bits plus a run of equal hashes
+    flips = np.uint64(1) << rng.integers(0, 63, 100).astype(np.uint64)
+    hashes[100:200] = hashes[:100] ^ flips
+    hashes[200:300] = hashes[:100] ^ flips ^ (flips << np.uint64(1))
+    hashes[300:310] = 0
+    index = HammingIndex(hashes, np.arange(1000) + 10, radius=radius)
+
+    first, second, distances = index.pairs()
+    xor = hashes[:, None] ^ hashes[None, :]
+    expected = popcount(xor.ravel()).reshape(xor.shape)
+    rows, cols = np.nonzero(np.triu(expected <= radius, 1))
+    assert sorted(zip(first.tolist(), second.tolist())) == sorted(
+        zip((rows + 10).tolist(), (cols + 10).tolist())
+    )
+    assert (distances == expected[first - 10, second - 10]).all()
+
+
+def test_popcount():
+    values = np.array([0, 1, 2**64 - 1, 0b1011 << 60], dtype=np.uint64)
+    assert popcount(values).tolist() == [0, 1, 64, 3]
+
+
+def test_hamming_query_with_updates(tmp_path):
+    rng = np.random.default_rng(8)
+    hashes = rng.integers(0, 2**64 - 1, 600, dtype=np.uint64, endpoint=True)
+    hashes[300:400] = hashes[:100] ^ np.uint64(0b101)
+    index = HammingIndex(hashes[:500], np.arange(500), radius=2)
+    index.insert(hashes[500:], np.arange(500, 600))
+    index.remove(np.arange(0, 600, 7))
+    alive = np.arange(600) % 7 != 0
+
+    queries = np.concatenate((hashes[:100], hashes[550:560] ^ np.uint64(1)))
+    saved = tmp_path / "hashes"
+    index.save(str(saved))
+    loaded, _ = HammingIndex.load(str(saved))
+    for searched in (index, loaded):
+        positions, ids, distances = searched.query(queries)
+        xor = queries[:, None] ^ hashes[None, :]
+        expected = popcount(xor.ravel()).reshape(xor.shape)
+        rows, cols = np.nonzero((expected <= 2) & alive[None, :])
+        assert sorted(zip(positions.tolist(), ids.tolist())) == sorted(
+            zip(rows.tolist(), cols.tolist())
+        )
+        assert (distances == expected[positions, ids]).all()
+
+
+def test_concurrent_snapshot_saves(tmp_path):
+    path = str(tmp_path / "hashes")
+    indexes = [
+        HammingIndex(np.arange(size, dtype=np.uint64), np.arange(size), radius=1)
+        for size in (100, 200, 300, 400)
+    ]
+    # Writers never share temp files, so none of them fail or leave one behind
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        for future in [pool.submit(index.save, path) for index in indexes]:
+            future.result()
+    assert sorted(os.listdir(tmp_path)) == ["hashes.json", "hashes.npy"]
+
+
+def test_saving_loaded_snapshot_releases_map(tmp_path):
+    path = str(tmp_path / "hashes")
+    HammingIndex(np.arange(50, dtype=np.uint64), np.arange(50), radius=1).save(path)
+    loaded, _ = HammingIndex.load(path)
+    assert isinstance(loaded.hashes.base, np.memmap)
+    # The snapshot can only be replaced once nothing maps it
+    loaded.save(path)
+    assert not isinstance(loaded.hashes.base, np.memmap)
+    reloaded, _ = HammingIndex.load(path)
+    _, found, _ = reloaded.query(np.array([3], dtype=np.uint64))
+    assert sorted(found.tolist()) == [1, 2, 3, 7, 11, 19, 35]
@@ -0,0 +1,320 @@
+import numpy as np
+
+from app.analyze import Inspector
+from app.colors import hex_to_bin, lab_histogram
+from app.db import (
+    Wallpaper,
+    WallpaperColorBin,
+    WallpaperQuery,
+    bulk_insert_colors,
+    bulk_update_wallpapers,
+    color_bins,
+    create_session,
+    create_tables,
+    feature_vectors,
+    featureless_listings,
+    features_since,
+    library_generation,
+    library_state,
+    library_stats,
+    refresh_library_stats,
+    rehash_wide_hashes,
+    save_features,
+    set_duplicate,
+    unanalyzed_listings,
+    wallpaper_listings,
+)
+from app.search import ColorSearch, DuplicateSearch, FeatureSearch, ImageSearch, Search
+from tests.helpers import add_wallpapers
+
+RED, GREEN, BLUE, YELLOW = 0xFF0000, 0x00FF00, 0x0000FF, 0xFFFF00
+
+
+def test_colors_ranked_once_per_wallpaper(library):
+    """
+    Wallpapers matching several searched colors should show up once
+    and rank above single or weaker matches
+    """
+    add_wallpapers(4)
+    bulk_insert_colors(
+        {1: [RED, GREEN, BLUE], 2: [GREEN, RED], 3: [BLUE, YELLOW], 4: [YELLOW]}
+    )
+    red, green, blue = hex_to_bin([RED, GREEN, BLUE]).tolist()
+    query = WallpaperQuery({"colors": {red: 0.0, green: 1.0, blue: 5.0}})
+    assert [wallpaper.id for wallpaper in query()] == [1, 2, 3]
+    assert WallpaperQuery({"colors": {}})() == []
+
+
+def test_colors_limit_counts_wallpapers(library):
+    add_wallpapers(3)
+    bulk_insert_colors({1: [RED, GREEN], 2: [RED, GREEN], 3: [GREEN]})
+    red, green = hex_to_bin([RED, GREEN]).tolist()
+    query = WallpaperQuery({"colors": {red: 0.0, green: 0.0}})
+    assert [wallpaper.id for wallpaper in query(limit=2)] == [1, 2]
+
+
+def test_color_bins_backfilled_from_palettes(library):
+    add_wallpapers(2)
+    # Close shades share a bin, their palette weights add up
+    bulk_insert_colors({1: [RED, 0xFE0000, BLUE], 2: [BLUE]})
+    with create_session() as session:
+        session.query(WallpaperColorBin).delete()
+        session.commit()
+    create_tables()
+    red, blue = hex_to_bin([RED, BLUE]).tolist()
+    assert sorted(color_bins()) == sorted([red, blue])
+    with create_session() as session:
+        weights = session.query(WallpaperColorBin.weight).filter(
+            WallpaperColorBin.wallpaper_id == 1, WallpaperColorBin.bin == red
+        )
+        assert weights.scalar() == 1.5
+
+
+def test_listings_keep_requested_order(library):
+    add_wallpapers(5)
+    listings = wallpaper_listings([4, 1, 5, 99, 2])
+    assert [listing.id for listing in listings] == [4, 1, 5, 2]
+    assert listings[0].filename == "local3.jpg"
+    assert listings[0].src_path == "/images/local3.jpg"
+
+
+def test_unanalyzed_listings_after_id(library):
+    add_wallpapers(5, analyzed=False)
+    assert [row.id for row in unanalyzed_listings(2, after_id=2)] == [3, 4]
+
+
+def test_query_by_ids_keeps_requested_order(library):
+    add_wallpapers(5)
+    query = WallpaperQuery({"ids": [3, 5, 1]})
+    assert [listing.id for listing in query()] == [3, 5, 1]
+    assert WallpaperQuery({"ids": []})() == []
+
+
+def test_writes_bump_generation(library):
+    assert library_generation() == 0
+    add_wallpapers(2)
+    set_duplicate([1])
+    assert library_generation() == 2
+
+
+def test_search_results_cached_until_library_changes(library):
+    add_wallpapers(2)
+    search = Search()
+    table, _ = search.find()
+    assert [row[0] for row in table] == [1, 2]
+    assert len(search._results) == 1
+    search.find()
+    assert len(search._results) == 1
+    set_duplicate([1])
+    table, _ = search.find()
+    assert [row[0] for row in table] == [2]
+
+
+def test_library_stats_follow_writes(library):
+    add_wallpapers(3, analyzed=False)
+    add_wallpapers(2, source_type="reddit")
+    bulk_update_wallpapers(
+        [{"id": 1, "dhash": "1", "width": 1, "height": 1, "analyzed": True}]
+    )
+    set_duplicate([1, 4])
+    set_duplicate([1])
+    stats = library_stats()
+    assert stats["local"] == (3, 1, 1)
+    assert stats["local"].unanalyzed == 2
+    assert stats["reddit"] == (2, 2, 1)
+
+    refresh_library_stats()
+    assert library_stats() == stats
+
+
+def test_color_index_updates_from_snapshot(library):
+    add_wallpapers(2)
+    bulk_insert_colors({1: [RED]})
+    search = ColorSearch()
+    red, blue = hex_to_bin([RED, BLUE]).tolist()
+    assert list(search("#fe0000", 5)) == [red]
+
+    bulk_insert_colors({2: [BLUE, RED]})
+    search.refresh()
+    assert list(search("#0000fe", 5)) == [blue, red]
+
+    # A new instance starts from the saved snapshot
+    reloaded = ColorSearch()
+    assert reloaded.watermark == search.watermark
+    assert sorted(reloaded.index.ids.tolist()) == sorted([red, blue])
+
+
+def test_duplicates_within_radius(library):
+    add_wallpapers(4, analyzed=False)
+    hashes = {1: 2**63 + 0b1111, 2: 2**63 + 0b1110, 3: 0b1100, 4: 0b111 << 40}
+    bulk_update_wallpapers(
+        [
+            {"id": _id, "dhash": str(dhash), "width": 1, "height": 1, "analyzed": True}
+            for _id, dhash in hashes.items()
+        ]
+    )
+    search = DuplicateSearch()
+    assert search.duplicates(radius=0) == {}
+    assert search.duplicates(radius=1) == {1: [2]}
+    assert search.duplicates(radius=3) == {1: [2, 3]}
+
+
+def test_wide_hashes_are_rehashed(library):
+    # New libraries are marked as converted when the tables are created
+    assert library_state("dhash_version") == 1
+    add_wallpapers(2, analyzed=False)
+    bulk_update_wallpapers(
+        [
+            {
+                "id": 1,
+                "dhash": str(1 << 191),
+                "width": 1,
+                "height": 1,
+                "analyzed": True,
+            },
+            {"id": 2, "dhash": "7", "width": 1, "height": 1, "analyzed": True},
+        ]
+    )
+    bulk_insert_colors({1: [RED], 2: [BLUE]})
+    rehash_wide_hashes()
+    with create_session() as session:
+        rows = session.query(Wallpaper.dhash, Wallpaper.analyzed).order_by(Wallpaper.id)
+        assert rows.all() == [(None, False), ("7", True)]
+        assert session.query(WallpaperColorBin.wallpaper_id).distinct().all() == [(2,)]
+    assert library_stats()["local"].analyzed == 1
+
+
+def test_similar_ranks_by_hash_distance(library):
+    add_wallpapers(5, analyzed=False)
+    hashes = {1: 0b0000, 2: 0b0111, 3: 0b0001, 4: 0b0011, 5: 0b0001}
+    bulk_update_wallpapers(
+        [
+            {"id": _id, "dhash": str(dhash), "width": 1, "height": 1, "analyzed": True}
+            for _id, dhash in hashes.items()
+        ]
+    )
+    search = DuplicateSearch()
+    assert search.similar(1) == [1, 3, 5, 4, 2]
+    assert search.similar(4, n_images=3) == [4, 2, 3]
+    assert search.similar(99) == []
+
+
+def test_duplicate_groups_are_disjoint_and_paged(library):
+    add_wallpapers(7, analyzed=False)
+    # 1-2-3 chain together through 2, 5 is the largest image of its group
+    hashes = {
+        1: 0b000,
+        2: 0b001,
+        3: 0b011,
+        4: 0b111 << 40,
+        5: 0b110 << 40,
+        6: 0b11 << 62,
+    }
+    bulk_update_wallpapers(
+        [
+            {
+                "id": _id,
+                "dhash": str(dhash),
+                "width": 10 if _id == 5 else 1,
+                "height": 1,
+                "analyzed": True,
+            }
+            for _id, dhash in hashes.items()
+        ]
+    )
+    search = DuplicateSearch()
+    assert list(search.groups(radius=1)) == [[[1, 2, 3], [5, 4]]]
+    assert list(search.groups(radius=1, page_size=3)) == [[[1, 2, 3]], [[5, 4]]]
+    assert list(search.groups(radius=1, page_size=2)) == [[[1, 2]], [[3]], [[5, 4]]]
+    assert search.duplicates(radius=1) == {1: [2, 3], 5: [4]}
+
+
+def test_unloadable_images_not_backfilled_again(library, monkeypatch):
+    add_wallpapers(3)
+    red = lab_histogram(np.tile([[250, 10, 10]], (50, 1))).tobytes()
+    save_features({2: red})
+    loads = []
+
+    def load(uris, timeout):
+        loads.append(uris)
+        return [None] * len(uris), []
+
+    monkeypatch.setattr("app.analyze.load", load)
+    assert Inspector().backfill_features() == 0
+    assert featureless_listings(10) == []
+    assert Inspector().backfill_features() == 0
+    assert len(loads) == 1 and len(loads[0]) == 2
+    assert feature_vectors([1, 2, 3]) == {2: red}
+
+    # An image that loads later replaces its empty vector as a new row
+    vectors, watermark = features_since(0)
+    assert vectors == [(2, red)]
+    save_features({1: red})
+    assert features_since(watermark)[0] == [(1, red)]
+
+
+def test_feature_search_finds_look_alikes(library):
+    add_wallpapers(4)
+    rng = np.random.default_rng(2)
+    reds = rng.integers((150, 0, 0), (256, 60, 60), (3, 100, 3))
+    blues = rng.integers((0, 0, 150), (60, 60, 256), (1, 100, 3))
+    vectors = [lab_histogram(pixels).tobytes() for pixels in (*reds, *blues)]
+    save_features({1: vectors[0], 2: vectors[3]})
+
+    search = FeatureSearch()
+    assert search.similar([1]) == [1, 2]
+    # Vectors saved later are added to the cached matrix
+    save_features({3: vectors[1], 4: vectors[2]})
+    assert search.similar([1], n_images=3)[0] == 1
+    assert set(search.similar([1], n_images=3)) == {1, 3, 4}
+    assert search.similar([2], n_images=1) == [2]
+
+
+def test_image_search_matches_outside_image(library):
+    add_wallpapers(3, analyzed=False)
+    red = lab_histogram(np.tile([[250, 10, 10]], (50, 1))).tobytes()
+    blue = lab_histogram(np.tile([[10, 10, 250]], (50, 1))).tobytes()
+    bulk_update_wallpapers(
+        [
+            {"id": _id, "dhash": str(dhash), "width": 1, "height": 1, "analyzed": True}
+            for _id, dhash in ((1, 0b1011), (2, 0b1010), (3, 2**63))
+        ]
+    )
+    bulk_insert_colors({1: [RED], 2: [BLUE], 3: [RED, BLUE]})
+    save_features({1: red, 2: blue, 3: red})
+
+    search = ImageSearch(ColorSearch(), DuplicateSearch(), FeatureSearch())
+    matches = search({"dhash": str(0b1011)}, [RED], red, n_images=2)
+    assert matches.duplicates == [1, 2]
+    assert matches.similar == [1, 2]
+    assert sorted(matches.look_alikes) == [1, 3]
+    assert sorted(matches.palette) == [1, 3]
+    assert matches.ids == [1, 2, 3]
+
+
+def test_image_search_keeps_every_kind_of_match(library):
+    """
+    The nearest dhashes of a large library are mostly unrelated images,
+    they should not crowd out the look alike and palette matches
+    """
+    add_wallpapers(30, analyzed=False)
+    # At least 40 bits away from the searched hash
+    far = [(2**40 - 1) << 8 | _id for _id in range(2, 31)]
+    bulk_update_wallpapers(
+        [
+            {"id": _id, "dhash": str(dhash), "width": 1, "height": 1, "analyzed": True}
+            for _id, dhash in zip(range(1, 31), [0, *far])
+        ]
+    )
+    red = lab_histogram(np.tile([[250, 10, 10]], (50, 1))).tobytes()
+    blue = lab_histogram(np.tile([[10, 10, 250]], (50, 1))).tobytes()
+    bulk_insert_colors({_id: [RED if _id in (1, 29) else BLUE] for _id in range(1, 31)})
+    save_features({_id: red if _id in (1, 30) else blue for _id in range(1, 31)})
+
+    search = ImageSearch(ColorSearch(), DuplicateSearch(), FeatureSearch())
+    matches = search({"dhash": "0"}, [RED], red)
+    assert matches.duplicates == [1]
+    assert matches.similar == [1]
+    assert matches.look_alikes[:2] == [1, 30]
+    assert matches.palette[:2] == [1, 29]
+    assert matches.ids[:3] == [1, 30, 29]
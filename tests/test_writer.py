@@ -0,0 +1,60 @@
+from app.db import (
+    Wallpaper,
+    WallpaperColor,
+    create_session,
+    duplicate_pairs,
+    feature_vectors,
+    unanalyzed_listings,
+)
+from app.duplicates import DuplicateIndex
+from app.index import HammingIndex
+from app.writer import AnalysisWriter
+from tests.helpers import add_wallpapers
+
+
+def analysis(_id):
+    return {"id": _id, "dhash": str(_id), "width": 16, "height": 9, "analyzed": True}
+
+
+def test_writer_saves_all_results(library):
+    add_wallpapers(5, analyzed=False)
+    with AnalysisWriter(batch_size=2) as writer:
+        for _id in range(1, 6):
+            writer.put(analysis(_id), [_id, _id + 1], bytes([_id]) * 4)
+
+    assert writer.written == 5
+    assert unanalyzed_listings(10) == []
+    with create_session() as session:
+        assert session.query(Wallpaper).filter(Wallpaper.width == 16).count() == 5
+        assert session.query(WallpaperColor).count() == 10
+    assert feature_vectors([2, 5]) == {2: b"\x02" * 4, 5: b"\x05" * 4}
+
+
+def test_writer_finds_new_duplicates(library):
+    add_wallpapers(4, analyzed=False)
+    with AnalysisWriter() as writer:
+        writer.put({**analysis(1), "dhash": str(0b1111 << 40)}, [])
+    assert DuplicateIndex.exists()
+
+    # Later images are only checked against the saved index
+    with AnalysisWriter() as writer:
+        writer.put({**analysis(2), "dhash": str(0b1110 << 40)}, [])
+        writer.put({**analysis(3), "dhash": str(0b1100 << 40)}, [])
+        writer.put({**analysis(4), "dhash": str(0b11111 << 59)}, [])
+    assert sorted(duplicate_pairs(4)) == [(1, 2, 1), (1, 3, 2), (2, 3, 1)]
+    assert sorted(duplicate_pairs(1)) == [(1, 2, 1), (2, 3, 1)]
+
+
+def test_writer_only_saves_changed_index(library, monkeypatch):
+    add_wallpapers(2, analyzed=False)
+    with AnalysisWriter() as writer:
+        writer.put(analysis(1), [])
+    saves = []
+    monkeypatch.setattr(HammingIndex, "save", lambda *args: saves.append(args))
+    # Nothing new to index, so the snapshot is left alone
+    with AnalysisWriter() as writer:
+        writer.put({**analysis(2), "dhash": None}, [])
+    assert saves == []
+    with AnalysisWriter() as writer:
+        writer.put(analysis(2), [])
+    assert len(saves) == 1